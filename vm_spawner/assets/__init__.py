@@ -1,24 +1,26 @@
+import functools
+import os
 from pathlib import Path
 
 from vm_spawner.data import Provider
 
+_ASSETS_ROOT = Path(__file__).parent
 
-def get_cloud_asset(provider: Provider | str, asset_name: str) -> Path:
-    curr = Path(__file__).parent
-    if isinstance(provider, str):
-        asset = curr / provider / asset_name
-    else:
-        asset = curr / provider.value / asset_name
-    if not asset.exists():
+
+@functools.lru_cache(maxsize=64)
+def _resolve_asset(*parts: str) -> Path:
+    # The asset tree is static for the lifetime of the process
+    asset = _ASSETS_ROOT.joinpath(*parts)
+    if not os.path.exists(asset):  # noqa: PTH110 cheaper than Path.exists
         msg = f"{asset} does not exist"
         raise ValueError(msg)
     return asset
 
 
+def get_cloud_asset(provider: Provider | str, asset_name: str) -> Path:
+    provider_name = provider if isinstance(provider, str) else provider.value
+    return _resolve_asset(provider_name, asset_name)
+
+
 def get_script_asset(asset_name: str) -> Path:
-    curr = Path(__file__).parent
-    asset = curr / "scripts" / asset_name
-    if not asset.exists():
-        msg = f"{asset} does not exist"
-        raise ValueError(msg)
-    return asset
+    return _resolve_asset("scripts", asset_name)
@@ -3,28 +3,38 @@
 import argparse
 import logging
 import os
+import re
+import sys
+from collections.abc import Iterator
 from pathlib import Path
+from typing import Any
 
 from vm_spawner.custom_logger import setup_logging
-from vm_spawner.data import ArgMachine, Config, Provider, SSHKeyPair
+from vm_spawner.data import (
+    DEFAULT_PROVIDER,
+    PROVIDER_VALUES,
+    ArgMachine,
+    Config,
+    Provider,
+    SSHKeyPair,
+)
 from vm_spawner.dirs import user_cache_dir, user_data_dir
 from vm_spawner.errors import VmSpawnError
-from vm_spawner.ssh import generate_ssh_key, ssh_into_machine
-from vm_spawner.terraform import tr_create, tr_destroy, tr_metadata
 
 log = logging.getLogger(__name__)
 
+# '<name>|<arch>[|<os_image>]', capturing each field without surrounding whitespace
+_MACHINE_ARG_RE = re.compile(r"\s*([^|]*?)\s*\|\s*([^|]*?)\s*(?:\|\s*([^|]*?)\s*)?")
+
 
 def parse_machine_arg(machine_str: str) -> ArgMachine:
     """Parses a machine string argument into an ArgMachine dictionary."""
-    parts = machine_str.split("|")
-    if len(parts) < 2 or len(parts) > 3:
+    match = _MACHINE_ARG_RE.fullmatch(machine_str)
+    if match is None:
         msg = f"Invalid machine format: '{machine_str}'. Expected '<name>|<arch>[|<os_image>]'."
         raise argparse.ArgumentTypeError(msg)
 
-    name = parts[0].strip()
-    arch = parts[1].strip()
-    os_image = parts[2].strip() if len(parts) == 3 else None
+    name, arch, os_image = match.groups()
 
     if not name:
         msg = f"Machine name cannot be empty in '{machine_str}'."
@@ -36,11 +46,32 @@ def parse_machine_arg(machine_str: str) -> ArgMachine:
     return {"name": name, "arch": arch, "os_image": os_image}
 
 
-def create_parser() -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--debug", action="store_true", help="Enable debug mode")
-    subparsers = parser.add_subparsers(dest="subcommand")
+# Maps every accepted spelling of a subcommand to its canonical name.
+_SUBCOMMAND_ALIASES = {
+    "create": "create",
+    "c": "create",
+    "destroy": "destroy",
+    "d": "destroy",
+    "meta": "meta",
+    "m": "meta",
+    "ssh": "ssh",
+    "s": "ssh",
+}
+
+
+def _add_debug_argument(subparser: argparse.ArgumentParser) -> None:
+    # --debug is accepted before and after the subcommand. A subparser writes
+    # its defaults over the root parser's values, SUPPRESS keeps it from
+    # resetting a --debug given before the subcommand.
+    subparser.add_argument(
+        "--debug",
+        action="store_true",
+        default=argparse.SUPPRESS,
+        help="Enable debug mode",
+    )
+
 
+def _add_create_parser(subparsers: Any) -> None:
     create_parser = subparsers.add_parser(
         "create", help="Create resources", aliases=["c"]
     )
@@ -53,13 +84,13 @@ def create_parser() -> argparse.ArgumentParser:
         help="Specify a machine in the format '<name>|<arch>[|<os_image>]'. Can be used multiple times.",
         default=[],
     )
-    create_parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    _add_debug_argument(create_parser)
     create_parser.add_argument(
         "-p",
         "--provider",
         help="Cloud provider to use",
-        choices=[p.value for p in Provider],
-        default=Provider.Hetzner.value,
+        choices=PROVIDER_VALUES,
+        default=DEFAULT_PROVIDER,
     )
     create_parser.add_argument(
         "--ssh-pubkey",
@@ -68,47 +99,101 @@ def create_parser() -> argparse.ArgumentParser:
     )
     create_parser.add_argument("--location", help="Server location")
 
+
+def _add_destroy_parser(subparsers: Any) -> None:
     destroy_parser = subparsers.add_parser(
         "destroy", help="Destroy resources", aliases=["d"]
     )
-    destroy_parser.add_argument(
-        "--debug", action="store_true", help="Enable debug mode"
-    )
+    _add_debug_argument(destroy_parser)
     destroy_parser.add_argument(
         "--provider",
-        choices=[p.value for p in Provider],
-        default=Provider.Hetzner.value,
+        choices=PROVIDER_VALUES,
+        default=DEFAULT_PROVIDER,
     )
     destroy_parser.add_argument(
         "--force", action="store_true", help="Delete local data even if remote fails"
     )
 
+
+def _add_meta_parser(subparsers: Any) -> None:
     metadata_parser = subparsers.add_parser("meta", help="Show metadata", aliases=["m"])
-    metadata_parser.add_argument(
-        "--debug", action="store_true", help="Enable debug mode"
-    )
+    _add_debug_argument(metadata_parser)
     metadata_parser.add_argument(
         "--provider",
         help="Cloud provider to use",
-        choices=[p.value for p in Provider],
-        default=Provider.Hetzner.value,
+        choices=PROVIDER_VALUES,
+        default=DEFAULT_PROVIDER,
     )
 
+
+def _add_ssh_parser(subparsers: Any) -> None:
     ssh_parser = subparsers.add_parser("ssh", help="SSH into a machine", aliases=["s"])
-    ssh_parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    _add_debug_argument(ssh_parser)
     ssh_parser.add_argument("machine", help="Machine to SSH into")
     ssh_parser.add_argument(
         "--provider",
         help="Cloud provider to use",
-        choices=[p.value for p in Provider],
-        default=Provider.Hetzner.value,
+        choices=PROVIDER_VALUES,
+        default=DEFAULT_PROVIDER,
     )
 
+
+_SUBCOMMANDS_NEEDING_SSH_KEY = frozenset({"create", "ssh"})
+
+_SUBPARSER_BUILDERS = {
+    "create": _add_create_parser,
+    "destroy": _add_destroy_parser,
+    "meta": _add_meta_parser,
+    "ssh": _add_ssh_parser,
+}
+
+
+def sniff_subcommand(argv: list[str]) -> str | None:
+    """
+    Returns the canonical name of the subcommand in argv without running argparse,
+    or None if the first positional token is missing or not a known subcommand.
+    """
+    for token in argv:
+        if token == "--debug":
+            continue
+        return _SUBCOMMAND_ALIASES.get(token)
+    return None
+
+
+def create_parser(subcommand: str | None = None) -> argparse.ArgumentParser:
+    """
+    Builds the argument parser. If subcommand is given only that subparser is
+    attached, otherwise all of them are (needed for the top-level help/errors).
+
+    The parser is deliberately not cached across processes: argparse parsers
+    can't be pickled (they register a local function) and building one takes
+    well under a millisecond, less than reading a cache file back would.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    # Every attribute read by run_cli/create_conf_obj exists regardless of subparser
+    parser.set_defaults(debug=False, ssh_pubkey=None, provider=DEFAULT_PROVIDER)
+    subparsers = parser.add_subparsers(dest="subcommand")
+
+    if subcommand is not None:
+        _SUBPARSER_BUILDERS[subcommand](subparsers)
+    else:
+        for add_subparser in _SUBPARSER_BUILDERS.values():
+            add_subparser(subparsers)
+
     return parser
 
 
+def _collect_pubkey_paths(args: argparse.Namespace) -> Iterator[Path]:
+    """Yields the user supplied SSH pubkeys: --ssh-pubkey first, then $SSH_PUBKEY_PATH."""
+    if ssh_pubkey := args.ssh_pubkey:
+        yield Path(ssh_pubkey)
+    if pubkey_path_str := os.environ.get("SSH_PUBKEY_PATH"):
+        yield Path(pubkey_path_str)
+
+
 def create_conf_obj(args: argparse.Namespace) -> Config:
-    is_debug = getattr(args, "debug", False)
+    is_debug = args.debug
     data_dir = user_data_dir() / "vm_spawner"
     data_dir.mkdir(parents=True, exist_ok=True)
     cache_dir = user_cache_dir() / "vm_spawner"
@@ -116,23 +201,16 @@ def create_conf_obj(args: argparse.Namespace) -> Config:
     tr_dir = data_dir / "terraform"
     clan_dir = data_dir / "clan"
 
-    gen_key = generate_ssh_key(data_dir)
-    ssh_keys = [gen_key]
+    ssh_keys: list[SSHKeyPair] = []
+    # Only create and ssh use the generated key, skip ssh-keygen for the rest
+    if _SUBCOMMAND_ALIASES.get(args.subcommand) in _SUBCOMMANDS_NEEDING_SSH_KEY:
+        from vm_spawner.ssh import generate_ssh_key
 
-    pubkey_path: Path | None = None
-    if getattr(args, "ssh_pubkey", False):
-        pubkey_path = Path(args.ssh_pubkey)
-        assert pubkey_path is not None
-        ssh_keys.append(
-            SSHKeyPair(private=pubkey_path.with_suffix(""), public=pubkey_path)
-        )
+        ssh_keys.append(generate_ssh_key(data_dir))
 
-    if pubkey_path_str := os.environ.get("SSH_PUBKEY_PATH"):
-        pubkey_path = Path(pubkey_path_str)
+    for pubkey_path in _collect_pubkey_paths(args):
         ssh_keys.append(
-            SSHKeyPair(
-                private=Path(pubkey_path).with_suffix(""), public=Path(pubkey_path)
-            )
+            SSHKeyPair(private=pubkey_path.with_suffix(""), public=pubkey_path)
         )
 
     return Config(
@@ -146,9 +224,14 @@ def create_conf_obj(args: argparse.Namespace) -> Config:
 
 
 def run_cli() -> None:
-    parser = create_parser()
+    parser = create_parser(sniff_subcommand(sys.argv[1:]))
     args = parser.parse_args()
 
+    if args.subcommand is None:
+        # Nothing to do, don't touch the data dirs or generate keys
+        parser.print_help()
+        return
+
     config = create_conf_obj(args)
 
     if config.debug:
@@ -160,8 +243,7 @@ def run_cli() -> None:
 
     log.debug("Debug mode enabled")
 
-    if getattr(args, "provider", False):
-        provider = Provider.from_str(args.provider)
+    provider = Provider.from_str(args.provider)
 
     if args.subcommand == "create" or args.subcommand == "c":
         machines: list[ArgMachine] = args.machine
@@ -169,6 +251,8 @@ def run_cli() -> None:
             msg = "No machines specified for creation. Add -m <machine>"
             raise VmSpawnError(msg)
 
+        from vm_spawner.terraform import tr_create
+
         tr_create(
             config,
             provider,
@@ -177,16 +261,20 @@ def run_cli() -> None:
         )
 
     elif args.subcommand == "destroy" or args.subcommand == "d":
+        from vm_spawner.terraform import tr_destroy
+
         tr_destroy(config, provider)
 
     elif args.subcommand == "meta" or args.subcommand == "m":
+        from vm_spawner.terraform import tr_metadata
+
         meta = tr_metadata(config)
         for machine in meta:
             print(machine)
 
     elif args.subcommand == "ssh" or args.subcommand == "s":
+        from vm_spawner.ssh import ssh_into_machine
+        from vm_spawner.terraform import tr_metadata
+
         tmachines = tr_metadata(config)
         ssh_into_machine(tmachines, args.machine, config.ssh_keys[0])
-
-    else:
-        parser.print_help()
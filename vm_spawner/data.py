@@ -9,10 +9,16 @@ class Provider(Enum):
 
     @staticmethod
     def from_str(label: str) -> "Provider":
-        if label in Provider._value2member_map_:
-            return Provider(Provider._value2member_map_[label])
-        msg = f"Unknown provider: {label}"
-        raise ValueError(msg)
+        try:
+            return _PROVIDER_BY_VALUE[label]
+        except KeyError:
+            msg = f"Unknown provider: {label}"
+            raise ValueError(msg) from None
+
+
+_PROVIDER_BY_VALUE: dict[str, Provider] = {p.value: p for p in Provider}
+PROVIDER_VALUES: tuple[str, ...] = tuple(_PROVIDER_BY_VALUE)
+DEFAULT_PROVIDER: str = Provider.Hetzner.value
 
 
 class ArgMachine(TypedDict):
@@ -33,13 +39,13 @@ class TrMachine(TypedDict):
     provider: Provider
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SSHKeyPair:
     private: Path
     public: Path
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Config:
     debug: bool
     data_dir: Path
@@ -1,32 +1,46 @@
+import functools
 import logging
 import os
 import sys
+from collections.abc import Callable
 from pathlib import Path
 
 log = logging.getLogger(__name__)
 
 
+def _win_local_app_data() -> Path:
+    return Path(os.getenv("LOCALAPPDATA") or Path("~\\AppData\\Local\\").expanduser())
+
+
+def _xdg_or(env_var: str, fallback: str) -> Callable[[], Path]:
+    """Returns a lookup preferring $env_var, else the given ~ relative fallback."""
+
+    def lookup() -> Path:
+        xdg_dir = os.getenv(env_var)
+        if xdg_dir:
+            return Path(xdg_dir)
+        return Path(fallback).expanduser()
+
+    return lookup
+
+
+# sys.platform is constant for the process, pick the implementations once
+if sys.platform == "win32":
+    _user_data_dir = _win_local_app_data
+    _user_cache_dir = _win_local_app_data
+elif sys.platform == "darwin":
+    _user_data_dir = _xdg_or("XDG_DATA_HOME", "~/Library/Application Support/")
+    _user_cache_dir = _xdg_or("XDG_CACHE_HOME", "~/Library/Caches/")
+else:
+    _user_data_dir = _xdg_or("XDG_DATA_HOME", "~/.local/share")
+    _user_cache_dir = _xdg_or("XDG_CACHE_HOME", "~/.cache")
+
+
+@functools.cache
 def user_data_dir() -> Path:
-    if sys.platform == "win32":
-        return Path(
-            Path(os.getenv("LOCALAPPDATA", Path("~\\AppData\\Local\\").expanduser()))
-        )
-    xdg_data = os.getenv("XDG_DATA_HOME")
-    if xdg_data:
-        return Path(xdg_data)
-    if sys.platform == "darwin":
-        return Path("~/Library/Application Support/").expanduser()
-    return Path("~/.local/share").expanduser()
+    return _user_data_dir()
 
 
+@functools.cache
 def user_cache_dir() -> Path:
-    if sys.platform == "win32":
-        return Path(
-            Path(os.getenv("LOCALAPPDATA", Path("~\\AppData\\Local\\").expanduser()))
-        )
-    xdg_cache = os.getenv("XDG_CACHE_HOME")
-    if xdg_cache:
-        return Path(xdg_cache)
-    if sys.platform == "darwin":
-        return Path("~/Library/Caches/").expanduser()
-    return Path("~/.cache").expanduser()
+    return _user_cache_dir()
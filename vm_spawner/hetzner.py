@@ -1,15 +1,121 @@
 #!/usr/bin/env python3
 
+import contextlib
+import functools
+import http.client
+import io
 import json
 import os
 import ssl
+import threading
 import urllib.error
-import urllib.parse
-import urllib.request
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any
 
+from vm_spawner.errors import VmSpawnError
+
 # Define the base URL for the Hetzner Cloud API v1
-HETZNER_API_BASE_URL = "https://api.hetzner.cloud/v1"
+HETZNER_API_HOST = "api.hetzner.cloud"
+HETZNER_API_BASE_PATH = "/v1"
+HETZNER_API_BASE_URL = f"https://{HETZNER_API_HOST}{HETZNER_API_BASE_PATH}"
+# Upper bound on concurrent page requests once the page count is known
+MAX_PAGE_WORKERS = 8
+
+
+@functools.cache
+def _default_ssl_context() -> ssl.SSLContext:
+    # Loading the CA bundle is costly, do it once per process and only when needed
+    return ssl.create_default_context()
+
+
+class _KeepAliveConnections:
+    """
+    Hands out one persistent HTTPS connection per thread, so every page a
+    thread fetches reuses the same TCP connection and TLS session.
+    http.client connections are not thread safe, hence one per thread.
+    """
+
+    def __init__(self, ssl_context: ssl.SSLContext) -> None:
+        self._ssl_context = ssl_context
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list[http.client.HTTPSConnection] = []
+
+    def get(self) -> http.client.HTTPSConnection:
+        conn: http.client.HTTPSConnection | None = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPSConnection(
+                HETZNER_API_HOST, 443, context=self._ssl_context, timeout=30
+            )
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def _fetch_page(
+    connections: _KeepAliveConnections,
+    path: str,
+    page: int,
+    per_page: int,
+    headers: dict[str, str],
+) -> dict[str, Any]:
+    """
+    Fetches a single page of a paginated Hetzner API listing over the calling
+    thread's keep-alive connection.
+
+    Returns:
+        The decoded JSON body of the page.
+    Raises:
+        urllib.error.HTTPError: For non-2xx responses.
+        urllib.error.URLError: For network/connection errors.
+        json.JSONDecodeError: If the body is not valid JSON.
+    """
+    # Both query parameters are plain integers, nothing needs escaping
+    target = f"{path}?page={page}&per_page={per_page}"
+    full_url = f"https://{HETZNER_API_HOST}{target}"
+
+    conn = connections.get()
+    try:
+        try:
+            conn.request("GET", target, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server dropped the idle keep-alive connection, reconnect once
+            conn.close()
+            conn.request("GET", target, headers=headers)
+            response = conn.getresponse()
+        # Always drain the body, the connection can only be reused afterwards
+        response_body_bytes = response.read()
+    except (http.client.HTTPException, OSError) as e:
+        conn.close()
+        raise urllib.error.URLError(e) from e
+
+    # Check if the request was successful (status code 200-299)
+    if not (200 <= response.status < 300):
+        raise urllib.error.HTTPError(
+            full_url,
+            response.status,
+            response.reason,
+            response.headers,
+            io.BytesIO(response_body_bytes),
+        )
+
+    # Parse the JSON body straight from bytes, json detects the UTF-8 encoding
+    data: dict[str, Any] = json.loads(response_body_bytes)
+    return data
+
+
+def _server_names_on_page(data: dict[str, Any]) -> Iterator[str]:
+    servers_on_page: list[dict[str, Any]] = data.get("servers", [])
+    return (server["name"] for server in servers_on_page if "name" in server)
 
 
 def get_hetzner_server_names(api_token: str) -> list[str]:
@@ -17,19 +123,22 @@ def get_hetzner_server_names(api_token: str) -> list[str]:
     Connects to the Hetzner Cloud API using only Python standard libraries
     to return a list of server names in the corresponding project.
 
-    Handles API pagination to retrieve all servers.
+    Handles API pagination to retrieve all servers. The first page is fetched
+    on its own to learn the page count, the remaining pages are fetched
+    concurrently. The order of the returned names is not significant.
 
     Args:
         api_token: Your Hetzner Cloud API token for the specific project.
 
     Returns:
-        A list of server names (strings).
-        Returns an empty list if no servers are found or in case of an error.
+        A list of server names (strings), empty if the project has no servers.
+    Raises:
+        VmSpawnError: If the API can't be reached, rejects the request or
+                      returns a malformed response.
     """
     all_server_names: list[str] = []
-    page = 1
     per_page = 50  # Max allowed by Hetzner API per page
-    endpoint = f"{HETZNER_API_BASE_URL}/servers"
+    path = f"{HETZNER_API_BASE_PATH}/servers"
 
     # Prepare headers for authentication and content type
     headers = {
@@ -38,114 +147,61 @@ def get_hetzner_server_names(api_token: str) -> list[str]:
         "User-Agent": "Python-urllib/3",  # Good practice to identify client
     }
 
-    # Optional: Create a default SSL context for HTTPS robustness
-    # This often helps avoid certificate verification issues on some systems
-    ssl_context = ssl.create_default_context()
-
-    while True:
-        # Prepare query parameters for pagination
-        params = {
-            "page": page,
-            "per_page": per_page,
-        }
-        query_string = urllib.parse.urlencode(params)
-        full_url = f"{endpoint}?{query_string}"
-
-        try:
-            # Create a request object
-            req = urllib.request.Request(full_url, headers=headers, method="GET")
-
-            # Make the request and open the URL
-            with urllib.request.urlopen(
-                req, context=ssl_context, timeout=30
-            ) as response:
-                # Check if the request was successful (status code 200-299)
-                if not (200 <= response.status < 300):
-                    print(f"HTTP Error: {response.status} {response.reason}")
-                    # Attempt to read error body for more details
-                    try:
-                        error_body = response.read().decode("utf-8", errors="ignore")
-                        print(f"Error details: {error_body}")
-                    except Exception:
-                        pass  # Ignore if reading error body fails
-                    break  # Exit loop on error
-
-                # Read the response body (bytes) and decode it (to string)
-                response_body_bytes = response.read()
-                response_body_str = response_body_bytes.decode(
-                    "utf-8"
-                )  # API uses UTF-8
-
-                # Parse the JSON response string into a Python dictionary
-                data: dict[str, Any] = json.loads(response_body_str)
-
-                # Extract server names from the current page
-                servers_on_page: list[dict[str, Any]] = data.get("servers", [])
-                if not servers_on_page:
-                    break  # No servers found on this page (might be end)
-
-                for server in servers_on_page:
-                    if "name" in server:
-                        all_server_names.append(server["name"])
-
-                # Check pagination metadata to see if there's a next page
-                pagination_info: dict[str, Any] | None = data.get("meta", {}).get(
-                    "pagination"
+    connections = _KeepAliveConnections(_default_ssl_context())
+
+    try:
+        data = _fetch_page(connections, path, 1, per_page, headers)
+        all_server_names.extend(_server_names_on_page(data))
+
+        # Check pagination metadata to see if there are more pages
+        pagination_info: dict[str, Any] = data.get("meta", {}).get("pagination") or {}
+        next_page: int | None = pagination_info.get("next_page")
+        last_page: int | None = pagination_info.get("last_page")
+
+        if next_page and last_page and last_page >= next_page:
+            # Page count is known, fetch all remaining pages at once
+            with ThreadPoolExecutor(
+                max_workers=min(MAX_PAGE_WORKERS, last_page - next_page + 1)
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _fetch_page, connections, path, page, per_page, headers
+                    )
+                    for page in range(next_page, last_page + 1)
+                ]
+                for future in as_completed(futures):
+                    all_server_names.extend(_server_names_on_page(future.result()))
+        else:
+            # No usable last_page given, follow next_page one page at a time
+            while next_page:
+                data = _fetch_page(connections, path, next_page, per_page, headers)
+                all_server_names.extend(_server_names_on_page(data))
+                next_page = (data.get("meta", {}).get("pagination") or {}).get(
+                    "next_page"
                 )
-                if pagination_info and pagination_info.get("next_page"):
-                    page = pagination_info[
-                        "next_page"
-                    ]  # API tells us the next page number
-                    # print(f"Fetching next page: {page}") # Optional: for debugging
-                else:
-                    break  # No more pages
-
-        except urllib.error.HTTPError as http_err:
-            # Handle HTTP errors (e.g., 401 Unauthorized, 404 Not Found) raised by urlopen
-            print(f"HTTP error occurred: {http_err.code} {http_err.reason}")
-            try:
-                # Try reading the error response body if available
-                error_content = http_err.read().decode("utf-8", errors="ignore")
-                print(f"Error content: {error_content}")
-            except Exception:
-                print("(Could not read error response body)")
-            break  # Exit loop on error
-        except urllib.error.URLError as url_err:
-            # Handle network/connection errors (e.g., DNS failure, connection refused)
-            print(f"URL error occurred: {url_err.reason}")
-            break  # Exit loop on error
-        except json.JSONDecodeError as json_err:
-            print(f"Error decoding JSON response: {json_err}")
-            # It might be helpful to see the raw response that failed parsing
-            # print(f"Raw response text: {response_body_str}")
-            break  # Exit loop on error
-        except Exception as e:
-            # Catch any other unexpected errors
-            print(f"An unexpected error occurred: {e}")
-            import traceback
-
-            traceback.print_exc()  # Print full traceback for unexpected errors
-            break  # Exit loop on error
+
+    except urllib.error.HTTPError as http_err:
+        # Handle HTTP errors (e.g., 401 Unauthorized, 404 Not Found)
+        msg = f"Hetzner API error: {http_err.code} {http_err.reason}"
+        with contextlib.suppress(Exception):
+            # Add the error response body if available
+            if error_content := http_err.read().decode("utf-8", errors="ignore"):
+                msg += f"\n{error_content}"
+        raise VmSpawnError(msg) from http_err
+    except urllib.error.URLError as url_err:
+        # Handle network/connection errors (e.g., DNS failure, connection refused)
+        msg = f"Could not reach the Hetzner API: {url_err.reason}"
+        raise VmSpawnError(msg) from url_err
+    except (json.JSONDecodeError, UnicodeDecodeError) as json_err:
+        # json.loads on the raw bytes raises the latter for invalid UTF-8
+        msg = f"Error decoding Hetzner API response: {json_err}"
+        raise VmSpawnError(msg) from json_err
+    finally:
+        connections.close()
 
     return all_server_names
 
 
-# --- Example Usage ---
 if __name__ == "__main__":
-    # Replace "YOUR_API_TOKEN" with the actual API token you generated
-    # It's HIGHLY recommended to load this from a secure location
-    # (environment variable, config file, secrets manager)
-    # rather than hardcoding it.
-    hetzner_api_token = os.environ.get("TF_VAR_hcloud_token", "YOUR_API_TOKEN")
-
-    if hetzner_api_token == "YOUR_API_TOKEN":
-        print("Please replace 'YOUR_API_TOKEN' with your actual Hetzner API token.")
-    else:
-        names = get_hetzner_server_names(hetzner_api_token)
-
-        if names:
-            print("Found the following server names:")
-            for name in names:
-                print(f"- {name}")
-        else:
-            print("No servers found or an error occurred during retrieval.")
+    for name in get_hetzner_server_names(os.environ["TF_VAR_hcloud_token"]):
+        print(name)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import sys
+import traceback
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+def configure_logging() -> None:
+    """
+    Sets up logging for the kvm entrypoint, once per process. The library
+    modules don't touch the global logging config when they are imported.
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+
+
+def _operation_errors() -> tuple[type[Exception], ...]:
+    """Exceptions reported as a failed operation, imported only once one is raised."""
+    import libvirt
+
+    from .remote import RemoteCommandError
+
+    return (
+        RemoteCommandError,
+        RuntimeError,
+        libvirt.libvirtError,
+        TimeoutError,
+        FileNotFoundError,
+        ValueError,
+    )
+
+
+# --- Argument Parsing ---
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Deploy or Destroy a KVM VM using cloud-init.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--remote-user-host",
+        type=str,
+        default="kvm@clan.lol",  # Example default
+        help="Remote host address in user@hostname format for SSH and libvirt.",
+        metavar="USER@HOST",
+    )
+
+    subparsers = parser.add_subparsers(
+        dest="subcommand", required=True, help="Sub-command help"
+    )
+
+    # --- Create Subcommand ---
+    crreate_parser = subparsers.add_parser(
+        "create", help="Create a new VM", aliases=["c"]
+    )
+    crreate_parser.add_argument(
+        "--ssh-key", type=Path, help="SSH key for remote access.", metavar="SSH_KEY"
+    )
+    crreate_parser.add_argument(
+        "--count",
+        type=int,
+        default=1,
+        help="Number of VMs to deploy, in parallel.",
+        metavar="N",
+    )
+
+    # --- Destroy Subcommand ---
+    destroy_parser = subparsers.add_parser(
+        "destroy", help="Destroy an existing VM", aliases=["d"]
+    )
+    destroy_parser.add_argument(
+        "--name",
+        type=str,
+        required=True,
+        help="Name of the VM to destroy.",
+        metavar="VM_NAME",
+    )
+    destroy_parser.add_argument(
+        "--ssh-key", type=Path, help="SSH key for remote access.", metavar="SSH_KEY"
+    )
+
+    args = parser.parse_args()
+    if getattr(args, "count", 1) < 1:
+        parser.error("--count must be at least 1")
+    return args
+
+
+def _print_deployed(name: str, ip: str, host: str) -> None:
+    print(f"VM Deployed: {name}")
+    print(f"IP Address:  {ip}")
+    print(f"Host:        {host}")
+    print("\nConnect via SSH (once cloud-init completes):")
+    print(f"ssh -J {host} root@{ip}")
+
+
+# --- Main Execution Logic ---
+def main() -> None:
+    configure_logging()
+    args = parse_arguments()
+    exit_code = 0
+    try:
+        if args.subcommand == "create" or args.subcommand == "c":
+            from .deploy_vm import BatchDeployError, deploy_vm_auto, deploy_vms_auto
+
+            if args.count == 1:
+                vm_infos = [
+                    deploy_vm_auto(host=args.remote_user_host, ssh_key=args.ssh_key)
+                ]
+            else:
+                try:
+                    vm_infos = deploy_vms_auto(
+                        [(args.remote_user_host, args.ssh_key)] * args.count
+                    )
+                except BatchDeployError as e:
+                    # Report the VMs that did come up, they keep running
+                    for vm_info in e.vm_configs:
+                        _print_deployed(vm_info.name, vm_info.ip, args.remote_user_host)
+                    raise
+            print("\n--- Success ---")
+            for vm_info in vm_infos:
+                _print_deployed(vm_info.name, vm_info.ip, args.remote_user_host)
+            print("Password is: root:terraform")
+        elif args.subcommand == "destroy" or args.subcommand == "d":
+            from .destroy import delete_vm
+
+            delete_vm(
+                host=args.remote_user_host, domain_name=args.name, ssh_key=args.ssh_key
+            )
+            print("\n--- Success ---")
+            print(
+                f"VM '{args.name}' deletion process completed on {args.remote_user_host}."
+            )
+        else:
+            # Should be caught by argparse 'required=True' on subcommand
+            print(
+                f"Error: Invalid subcommand '{args.subcommand}'. Use 'create' or 'destroy'.",
+                file=sys.stderr,
+            )
+            exit_code = 1
+
+    except _operation_errors() as e:
+        print("\n--- Error ---", file=sys.stderr)
+        print(f"Operation failed: {e}", file=sys.stderr)
+        # Add traceback for debugging if needed, or rely on logs
+        # traceback.print_exc(file=sys.stderr)
+        log.debug(
+            "Full traceback:", exc_info=True
+        )  # Log full trace if debug level is enabled
+        exit_code = 1
+    except KeyboardInterrupt:
+        print("\nOperation cancelled by user.", file=sys.stderr)
+        exit_code = 1
+    except Exception as e:
+        print("\n--- Unexpected Error ---", file=sys.stderr)
+        print(f"An unexpected error occurred: {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        exit_code = 1
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,23 @@
 
 # ruff: noqa: TRY301 TRY300
 
+import atexit
+import contextlib
+import functools
 import logging
+import threading
 
 import libvirt
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 log = logging.getLogger(__name__)
 
+# Send a keepalive after 5s of silence, drop the connection after 3 unanswered ones
+LIBVIRT_KEEPALIVE_INTERVAL = 5
+LIBVIRT_KEEPALIVE_COUNT = 3
+
+_connections: dict[str, libvirt.virConnect] = {}
+_connections_lock = threading.Lock()
+
 
 def connect_libvirt(uri: str) -> libvirt.virConnect:
     """Connects to the libvirt daemon."""
@@ -31,3 +38,64 @@ def connect_libvirt(uri: str) -> libvirt.virConnect:
     except libvirt.libvirtError as e:
         log.error(f"Failed to connect to libvirt at {uri}: {e}", exc_info=True)
         raise  # Re-raise the specific libvirt error
+
+
+@functools.cache
+def _start_event_loop() -> None:
+    """
+    Registers libvirt's default event loop and runs it in a daemon thread.
+    Keepalives are only sent and answered while it runs, it must be registered
+    before the first connection is opened.
+    """
+
+    def run() -> None:
+        while True:
+            if libvirt.virEventRunDefaultImpl() < 0:
+                log.warning("libvirt event loop iteration failed")
+
+    libvirt.virEventRegisterDefaultImpl()
+    threading.Thread(target=run, name="libvirt-events", daemon=True).start()
+
+
+def get_conn(uri: str) -> libvirt.virConnect:
+    """
+    Returns a libvirt connection to uri shared by all callers of this process,
+    so qemu+ssh:// URIs pay the SSH and libvirt handshake only once.
+    A connection that died in the meantime is replaced with a new one.
+    The connections are closed at exit, callers must not close them.
+
+    Raises:
+        libvirt.libvirtError: If the connection can't be opened.
+    """
+    with _connections_lock:
+        conn = _connections.get(uri)
+        if conn is not None:
+            with contextlib.suppress(libvirt.libvirtError):
+                if conn.isAlive():
+                    return conn
+            log.info(f"Cached libvirt connection to {uri} is dead, reconnecting...")
+            with contextlib.suppress(libvirt.libvirtError):
+                conn.close()
+
+        _start_event_loop()
+        conn = connect_libvirt(uri)
+        try:
+            # Keeps an idle connection (and the SSH tunnel below it) from timing
+            # out, and lets libvirt notice a dead one
+            conn.setKeepAlive(LIBVIRT_KEEPALIVE_INTERVAL, LIBVIRT_KEEPALIVE_COUNT)
+        except libvirt.libvirtError as e:
+            log.warning(f"Keepalive not supported on {uri}: {e}")
+        _connections[uri] = conn
+        return conn
+
+
+@atexit.register
+def _close_connections() -> None:
+    with _connections_lock:
+        for uri, conn in _connections.items():
+            try:
+                conn.close()
+                log.debug(f"Disconnected from libvirt at {uri}.")
+            except libvirt.libvirtError as e:
+                log.warning(f"Error during libvirt disconnect: {e}")
+        _connections.clear()
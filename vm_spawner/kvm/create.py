@@ -3,14 +3,35 @@
 # ruff: noqa: TRY301 TRY300
 
 import contextlib
+import errno
+import functools
+import hashlib
+import http.client
 import logging
+import os
+import re
 import shlex  # For safer command printing if needed later
-import subprocess
 import sys
+import threading
 import time
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from string import Template
+from typing import BinaryIO
+from xml.sax.saxutils import escape
 
-from .download import download_file
+from .download import (
+    PROGRESS_INTERVAL,
+    check_checksum,
+    discard_partial,
+    download_file,
+    download_lock,
+    open_url,
+    partial_path,
+    sha256_file,
+)
 from .remote import RemoteCommandError, run_remote_command
 
 # Assume libvirt is available
@@ -23,21 +44,449 @@ except ImportError:
     )
     sys.exit(1)
 
+log = logging.getLogger(__name__)
+
+# Bytes handed to a single stream.send() call when uploading a volume.
+# libvirt's per-send RPC overhead dominates with small chunks; stream.send()
+# only accepts bytes, so each chunk is a fresh read rather than a reused buffer.
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+_POOL_XML_TMPL = Template("""
+<pool type='$pool_type'>
+  <name>$name</name>
+  <target>
+    <path>$target_path</path>
+    <permissions>
+      <mode>0770</mode>
+      <owner>0</owner>
+      <group>$group_id</group>
+      <label>virt_image_t</label>
+    </permissions>
+  </target>
+</pool>
+""")
+
+_VOL_XML_TMPL = Template("""
+<volume type='file'>
+  <name>$name</name>
+  <capacity unit='bytes'>$capacity</capacity>
+  <target>
+    <format type='$fmt'/>
+    <permissions>
+      <mode>0644</mode>
+      <owner>0</owner>
+      <group>$group_id</group>
+    </permissions>
+  </target>
+</volume>
+""")
+
+
+def render_xml(
+    template: Template, fragments: dict[str, str] | None = None, **values: object
+) -> str:
+    """
+    Substitutes values into template, escaped for XML text and quoted attributes.
+    fragments are already rendered XML and substituted as they are.
+    """
+    return template.substitute(
+        {key: escape(str(value), {"'": "&apos;"}) for key, value in values.items()},
+        **(fragments or {}),
+    )
+
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+# copy_file_range errnos meaning "not between these files", not a failed copy
+_COPY_FILE_RANGE_UNSUPPORTED = frozenset(
+    {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF}
 )
-log = logging.getLogger(__name__)
 
+# First releases supporting <driver io='io_uring'/>: libvirt 6.3 and QEMU 5.0
+_IO_URING_MIN_LIBVIRT_VERSION = 6_003_000
+_IO_URING_MIN_QEMU_VERSION = 5_000_000
+_disk_io_by_conn: "weakref.WeakKeyDictionary[libvirt.virConnect, str]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def disk_driver_io(conn: libvirt.virConnect) -> str:
+    """
+    Returns the disk I/O mode for new domains: 'io_uring' if the libvirt daemon
+    and hypervisor behind conn support it, 'native' otherwise.
+    The probe runs once per connection.
+    """
+    io_mode = _disk_io_by_conn.get(conn)
+    if io_mode is None:
+        try:
+            supported = (
+                conn.getLibVersion() >= _IO_URING_MIN_LIBVIRT_VERSION
+                and conn.getVersion() >= _IO_URING_MIN_QEMU_VERSION
+            )
+        except libvirt.libvirtError as e:
+            log.warning(f"Could not determine hypervisor version: {e}")
+            supported = False
+        io_mode = "io_uring" if supported else "native"
+        log.info(f"Using disk I/O mode '{io_mode}'")
+        _disk_io_by_conn[conn] = io_mode
+    return io_mode
+
+
+def disk_driver_attrs(conn: libvirt.virConnect) -> dict[str, str]:
+    """Attributes of the <driver/> element for qcow2 disks of new domains."""
+    io_mode = disk_driver_io(conn)
+    return {
+        "name": "qemu",
+        "type": "qcow2",
+        # io='native' requires O_DIRECT, which means cache='none'
+        "cache": "writeback" if io_mode == "io_uring" else "none",
+        "io": io_mode,
+        "discard": "unmap",
+    }
+
+
+def disk_driver_xml(conn: libvirt.virConnect) -> str:
+    """Renders disk_driver_attrs as a libvirt domain XML <driver/> element."""
+    attrs = " ".join(
+        f"{key}='{value}'" for key, value in disk_driver_attrs(conn).items()
+    )
+    return f"<driver {attrs}/>"
+
+
+_HAS_FADVISE = hasattr(os, "posix_fadvise")  # Not available on macOS
+
+
+class _FileStreamSource:
+    """
+    Callbacks feeding a local file to virStream.sendAll/sparseSendAll.
+
+    Data is read in UPLOAD_CHUNK_SIZE pieces (libvirt would only ask for
+    ~256 KiB at a time), never past the current data section so holes found
+    via SEEK_DATA/SEEK_HOLE can be skipped rather than read as zeros.
+    If a hasher is given, everything sent (holes as zeros) is fed into it.
+
+    The image is read once, so its pages are dropped from the page cache
+    right after each chunk instead of evicting more useful data.
+    """
 
+    def __init__(
+        self, fd: int, total_size: int, hasher: "hashlib._Hash | None" = None
+    ) -> None:
+        self.fd = fd
+        self.total_size = total_size
+        self.hasher = hasher
+        self.sent_bytes = 0
+        # Without hole detection (plain sendAll) the whole file is one data section
+        self._data_left = total_size
+        # Progress is informational output, skip all of its math when INFO is off
+        self._show_progress = log.isEnabledFor(logging.INFO)
+        self._start_time = time.monotonic()
+        self._last_report = 0.0
+        if _HAS_FADVISE:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def hole(self, _stream: libvirt.virStream, _opaque: None) -> tuple[bool, int]:
+        """Returns (in_data, section_length) for the current file offset."""
+        cur = os.lseek(self.fd, 0, os.SEEK_CUR)
+        try:
+            data = os.lseek(self.fd, cur, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            # No data after cur, the remainder is a trailing hole (or EOF)
+            os.lseek(self.fd, cur, os.SEEK_SET)
+            self._data_left = 0
+            return False, self.total_size - cur
+        if data > cur:
+            os.lseek(self.fd, cur, os.SEEK_SET)
+            self._data_left = 0
+            return False, data - cur
+        hole = os.lseek(self.fd, cur, os.SEEK_HOLE)
+        os.lseek(self.fd, cur, os.SEEK_SET)
+        self._data_left = hole - cur
+        return True, self._data_left
+
+    def skip(self, _stream: libvirt.virStream, length: int, _opaque: None) -> int:
+        self.sent_bytes += length
+        if self.hasher is not None and length > 0:
+            # The hole reads back as zeros, hash it like the data it stands for
+            zeros = memoryview(bytes(min(UPLOAD_CHUNK_SIZE, length)))
+            for offset in range(0, length, len(zeros)):
+                self.hasher.update(zeros[: min(len(zeros), length - offset)])
+        return os.lseek(self.fd, length, os.SEEK_CUR)
+
+    def read(self, _stream: libvirt.virStream, _nbytes: int, _opaque: None) -> bytes:
+        offset = self.sent_bytes  # sent_bytes tracks the file position
+        chunk = os.read(self.fd, min(UPLOAD_CHUNK_SIZE, self._data_left))
+        self._data_left -= len(chunk)
+        self.sent_bytes += len(chunk)
+        if _HAS_FADVISE:
+            os.posix_fadvise(self.fd, offset, len(chunk), os.POSIX_FADV_DONTNEED)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+
+        # Progress reporting (optional), at most every PROGRESS_INTERVAL seconds
+        if not self._show_progress:
+            return chunk
+        now = time.monotonic()
+        if now - self._last_report < PROGRESS_INTERVAL and self._data_left:
+            return chunk
+        self._last_report = now
+        _print_upload_progress(self.sent_bytes, self.total_size, now - self._start_time)
+        return chunk
+
+
+class _DownloadStreamSource:
+    """
+    Callback feeding an HTTP download to virStream.sendAll while it arrives.
+
+    Every chunk is also written to cache_file and fed into hasher, so the
+    download ends up in the local cache without being read back from it.
+    """
+
+    def __init__(
+        self,
+        response: "http.client.HTTPResponse",
+        total_size: int,
+        cache_file: BinaryIO,
+        hasher: "hashlib._Hash",
+    ) -> None:
+        self.response = response
+        self.total_size = total_size
+        self.cache_file = cache_file
+        self.hasher = hasher
+        self.sent_bytes = 0
+        # Progress is informational output, skip all of its math when INFO is off
+        self._show_progress = log.isEnabledFor(logging.INFO)
+        self._start_time = time.monotonic()
+        self._last_report = 0.0
+
+    def read(self, _stream: libvirt.virStream, _nbytes: int, _opaque: None) -> bytes:
+        # Never more than announced, the volume's capacity is the Content-Length
+        chunk = self.response.read(
+            min(UPLOAD_CHUNK_SIZE, self.total_size - self.sent_bytes)
+        )
+        self.cache_file.write(chunk)
+        self.hasher.update(chunk)
+        self.sent_bytes += len(chunk)
+
+        # Progress reporting (optional), at most every PROGRESS_INTERVAL seconds
+        if not self._show_progress:
+            return chunk
+        now = time.monotonic()
+        if (
+            now - self._last_report < PROGRESS_INTERVAL
+            and self.sent_bytes != self.total_size
+        ):
+            return chunk
+        self._last_report = now
+        _print_upload_progress(self.sent_bytes, self.total_size, now - self._start_time)
+        return chunk
+
+
+def _print_upload_progress(
+    sent_bytes: int, total_size: int, elapsed_time: float
+) -> None:
+    speed = (sent_bytes / elapsed_time / 1024 / 1024) if elapsed_time > 0 else 0.0
+    percent = (sent_bytes / total_size) * 100 if total_size > 0 else 0.0
+    print(
+        f"\r  Uploaded {sent_bytes / 1024 / 1024:.2f} / {total_size / 1024 / 1024:.2f} MB"
+        f" ({percent:.1f}%) at {speed:.2f} MB/s",
+        end="",
+        flush=True,
+    )
+
+
+def is_local_connection(conn: libvirt.virConnect) -> bool:
+    """Returns True if conn talks to the libvirt daemon of this machine."""
+    return conn.getURI().startswith("qemu:///")
+
+
+def copy_into_local_volume(src_fd: int, vol_path: Path, size: int) -> bool:
+    """
+    Copies size bytes from src_fd over the volume file at vol_path with
+    copy_file_range, which the kernel turns into a reflink on XFS/Btrfs.
+
+    Returns:
+        True if the data was copied, False if this isn't possible here (no
+        write access, different filesystems, unsupported) and the caller
+        has to stream the data instead.
+    Raises:
+        OSError: If the copy fails after it started.
+    """
+    if not hasattr(os, "copy_file_range"):  # Linux only
+        return False
+    try:
+        dst_fd = os.open(vol_path, os.O_WRONLY)
+    except OSError as e:
+        log.debug(f"Can't open {vol_path} for an in-kernel copy: {e}")
+        return False
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                copied = os.copy_file_range(
+                    src_fd, dst_fd, size - offset, offset, offset
+                )
+            except OSError as e:
+                if offset == 0 and e.errno in _COPY_FILE_RANGE_UNSUPPORTED:
+                    log.debug(f"copy_file_range not usable for {vol_path}: {e}")
+                    return False
+                raise
+            if copied == 0:
+                msg = f"Source ended after {offset} of {size} bytes"
+                raise OSError(errno.EIO, msg)
+            offset += copied
+        # The volume libvirt created may be larger than the image copied over it
+        os.ftruncate(dst_fd, size)
+    finally:
+        os.close(dst_fd)
+    return True
+
+
+_pool_refresh_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+_pool_refresh_locks_guard = threading.Lock()
+
+
+def refresh_pool(pool: libvirt.virStoragePool) -> None:
+    """
+    Refreshes the pool so libvirt picks up files created behind its back.
+    Refreshes of the same pool are serialized, concurrent ones are not safe.
+    """
+    with _pool_refresh_locks_guard:
+        lock = _pool_refresh_locks[pool.UUIDString()]
+    with lock:
+        pool.refresh(0)
+    _forget_pool_volumes(pool)
+
+
+# Seconds a looked up pool or volume listing is reused without asking libvirt,
+# after that it is looked up again in case it was changed behind our back
+LOOKUP_CACHE_TTL = 300.0
+
+# Active pools by name per connection, see get_or_create_pool
+_active_pools: "weakref.WeakKeyDictionary[libvirt.virConnect, dict[str, tuple[float, libvirt.virStoragePool]]]" = weakref.WeakKeyDictionary()
+_active_pools_lock = threading.Lock()
+
+# Volume listings per pool UUID with when and over which connection they were
+# made (volume objects are bound to it), see lookup_volume
+_pool_volumes: dict[
+    str,
+    tuple[float, libvirt.virConnect, dict[str, libvirt.virStorageVol]],
+] = {}
+_pool_volumes_lock = threading.Lock()
+
+
+def forget_cached_lookups() -> None:
+    """
+    Drops all cached pools and volume listings, e.g. after an error that may
+    have been caused by one that went stale.
+    """
+    with _active_pools_lock:
+        _active_pools.clear()
+    with _pool_volumes_lock:
+        _pool_volumes.clear()
+
+
+def _cached_pool(conn: libvirt.virConnect, name: str) -> libvirt.virStoragePool | None:
+    with _active_pools_lock:
+        cached = _active_pools.get(conn, {}).get(name)
+    if cached is None or time.monotonic() - cached[0] >= LOOKUP_CACHE_TTL:
+        return None
+    return cached[1]
+
+
+def _remember_pool(
+    conn: libvirt.virConnect, name: str, pool: libvirt.virStoragePool
+) -> None:
+    with _active_pools_lock:
+        _active_pools.setdefault(conn, {})[name] = (time.monotonic(), pool)
+
+
+def lookup_volume(
+    pool: libvirt.virStoragePool, vol_name: str
+) -> libvirt.virStorageVol | None:
+    """
+    Returns the volume vol_name of pool, or None if it doesn't exist.
+    The pool is listed once and the listing reused for LOOKUP_CACHE_TTL
+    seconds, so deploying several VMs from one base image costs a single RPC.
+    Like pool lookups, a missing volume doesn't surface as an exception.
+
+    Raises:
+        libvirt.libvirtError: If the pool can't be listed.
+    """
+    uuid = pool.UUIDString()
+    # connect() and name() are answered from the local objects, not over RPC
+    conn = pool.connect()
+    with _pool_volumes_lock:
+        listing = _pool_volumes.get(uuid)
+        if (
+            listing is None
+            or listing[1] is not conn
+            or time.monotonic() - listing[0] >= LOOKUP_CACHE_TTL
+        ):
+            volumes = {vol.name(): vol for vol in pool.listAllVolumes(0)}
+            listing = (time.monotonic(), conn, volumes)
+            _pool_volumes[uuid] = listing
+        return listing[2].get(vol_name)
+
+
+def _remember_volume(pool: libvirt.virStoragePool, vol: libvirt.virStorageVol) -> None:
+    with _pool_volumes_lock:
+        if (listing := _pool_volumes.get(pool.UUIDString())) is not None:
+            listing[2][vol.name()] = vol
+
+
+def _forget_pool_volumes(pool: libvirt.virStoragePool) -> None:
+    with _pool_volumes_lock:
+        _pool_volumes.pop(pool.UUIDString(), None)
+
+
+@functools.cache
 def get_group_id(host: str, ssh_key: Path | None) -> str:
-    """Gets the group ID of the default group ('kvm') on the remote host."""
+    """
+    Gets the group ID of the default group ('kvm') on the remote host.
+    The result is cached per (host, ssh_key) for the lifetime of the process.
+    """
     log.info(f"Getting gid for default group on {host}...")
     # run_remote_command will raise RemoteCommandError if 'id -g' fails
-    group_id = run_remote_command(host, ["id", "-g"], ssh_key=ssh_key)
+    group_id = run_remote_command(host, ["id", "-g"], ssh_key=ssh_key).stdout
     log.info(f"Found group ID: {group_id}")
-    return group_id.stdout
+    return group_id
+
+
+_QEMU_IMG_VERSION_RE = re.compile(r"version (\d+)\.(\d+)")
+# qcow2 extended L2 entries (subcluster allocation) need QEMU >= 5.2
+_EXTENDED_L2_MIN_QEMU_IMG_VERSION = (5, 2)
+
+
+@functools.cache
+def get_qemu_img_version(host: str, ssh_key: Path | None) -> tuple[int, int] | None:
+    """
+    Gets the (major, minor) version of qemu-img on the remote host, or None if it
+    can't be determined. The result is cached per (host, ssh_key).
+    """
+    result = run_remote_command(
+        host, ["qemu-img", "--version"], check=False, ssh_key=ssh_key
+    )
+    match = _QEMU_IMG_VERSION_RE.search(result.stdout)
+    if result.returncode != 0 or match is None:
+        log.warning(f"Could not determine the qemu-img version on {host}.")
+        return None
+    version = (int(match.group(1)), int(match.group(2)))
+    log.info(f"Found qemu-img {version[0]}.{version[1]} on {host}")
+    return version
+
+
+def qcow2_clone_options(host: str, ssh_key: Path | None) -> str:
+    """
+    Returns the qemu-img '-o' options for a qcow2 overlay on a qcow2 backing file.
+    Lazy refcounts cut metadata writes at runtime, extended L2 entries let the
+    overlay allocate 4k subclusters on copy-on-write instead of whole clusters.
+    """
+    options = ["backing_fmt=qcow2", "lazy_refcounts=on"]
+    version = get_qemu_img_version(host, ssh_key)
+    if version is not None and version >= _EXTENDED_L2_MIN_QEMU_IMG_VERSION:
+        options += ["extended_l2=on", "cluster_size=128k"]
+    return ",".join(options)
 
 
 def get_or_create_pool(
@@ -50,6 +499,7 @@ def get_or_create_pool(
 ) -> libvirt.virStoragePool:
     """
     Gets an existing storage pool or creates a new one using libvirt-python.
+    The pool is remembered per connection for LOOKUP_CACHE_TTL seconds.
 
     Returns:
         The active libvirt.virStoragePool object.
@@ -58,88 +508,237 @@ def get_or_create_pool(
         libvirt.libvirtError: For underlying libvirt API errors.
         RemoteCommandError: If getting the remote group ID fails.
     """
-    pool: libvirt.virStoragePool | None = None
-    try:
-        log.info(f"Looking up storage pool '{name}'...")
-        pool = conn.storagePoolLookupByName(name)
-        log.info(f"Found existing storage pool '{name}'.")
-        if not pool.isActive():
-            log.info(f"Activating pool '{name}'...")
-            pool.create(0)
-            log.info(f"Pool '{name}' activated.")
+    pool = _cached_pool(conn, name)
+    if pool is not None:
+        log.info(f"Using storage pool '{name}' found earlier.")
         return pool
-    except libvirt.libvirtError as e:
-        if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_POOL:
-            log.info(f"Storage pool '{name}' not found. Creating...")
-            # Get group ID *before* attempting creation
-            group_id = get_group_id(host, ssh_key)
-
-            pool_xml_desc = f"""
-            <pool type='{pool_type}'>
-              <name>{name}</name>
-              <target>
-                <path>{target_path!s}</path>
-                <permissions>
-                  <mode>0770</mode>
-                  <owner>0</owner>
-                  <group>{group_id}</group>
-                  <label>virt_image_t</label>
-                </permissions>
-              </target>
-            </pool>
-            """
-            log.info(f"Defining pool '{name}' with XML:\n{pool_xml_desc}")
-            defined_pool: libvirt.virStoragePool | None = None
-            try:
-                defined_pool = conn.storagePoolDefineXML(pool_xml_desc, 0)
-                if defined_pool is None:
-                    # Should not happen if defineXML doesn't raise, but check anyway
-                    msg = f"Failed to define pool '{name}' (defineXML returned None)."
-                    log.error(msg)
-                    raise RuntimeError(msg)
-
-                log.info(f"Building pool '{name}'...")
-                try:
-                    # Build might try to create the directory
-                    defined_pool.build(0)
-                    log.info(f"Pool '{name}' built successfully.")
-                except libvirt.libvirtError as build_e:
-                    # For 'dir' type, build failure might be ok if dir exists
-                    # Log as warning but proceed to activate
-                    log.warning(
-                        f"Failed to explicitly build pool '{name}' "
-                        f"(may be harmless for '{pool_type}' type if path exists): {build_e}",
-                        exc_info=False,
-                    )
 
-                log.info(f"Setting autostart for pool '{name}'...")
-                defined_pool.setAutostart(1)
+    log.info(f"Looking up storage pool '{name}'...")
+    try:
+        # A single RPC like a lookup, but a missing pool doesn't surface as an
+        # exception. name() is answered from the local object, not over RPC.
+        pools = {pool.name(): pool for pool in conn.listAllStoragePools(0)}
+        pool = pools.get(name)
+        if pool is not None:
+            log.info(f"Found existing storage pool '{name}'.")
+            if not pool.isActive():
                 log.info(f"Activating pool '{name}'...")
-                defined_pool.create(0)  # Activate
-                log.info(
-                    f"Storage pool '{name}' created and activated at '{target_path}'."
+                pool.create(0)
+                log.info(f"Pool '{name}' activated.")
+            _remember_pool(conn, name, pool)
+            return pool
+    except libvirt.libvirtError as e:
+        log.error(f"Error looking up pool '{name}': {e}")
+        msg = f"Failed to look up storage pool '{name}'"
+        raise RuntimeError(msg) from e
+
+    log.info(f"Storage pool '{name}' not found. Creating...")
+    # Get group ID *before* attempting creation
+    group_id = get_group_id(host, ssh_key)
+
+    pool_xml_desc = render_xml(
+        _POOL_XML_TMPL,
+        pool_type=pool_type,
+        name=name,
+        target_path=target_path,
+        group_id=group_id,
+    )
+    log.info(f"Defining pool '{name}'...")
+    log.debug(f"Pool '{name}' XML:\n{pool_xml_desc}")
+    defined_pool: libvirt.virStoragePool | None = None
+    try:
+        defined_pool = conn.storagePoolDefineXML(pool_xml_desc, 0)
+        if defined_pool is None:
+            # Should not happen if defineXML doesn't raise, but check anyway
+            msg = f"Failed to define pool '{name}' (defineXML returned None)."
+            log.error(msg)
+            raise RuntimeError(msg)
+
+        log.info(f"Building pool '{name}'...")
+        try:
+            # Build might try to create the directory
+            defined_pool.build(0)
+            log.info(f"Pool '{name}' built successfully.")
+        except libvirt.libvirtError as build_e:
+            # For 'dir' type, build failure might be ok if dir exists
+            # Log as warning but proceed to activate
+            log.warning(
+                f"Failed to explicitly build pool '{name}' "
+                f"(may be harmless for '{pool_type}' type if path exists): {build_e}",
+                exc_info=False,
+            )
+
+        log.info(f"Setting autostart for pool '{name}'...")
+        defined_pool.setAutostart(1)
+        log.info(f"Activating pool '{name}'...")
+        defined_pool.create(0)  # Activate
+        log.info(f"Storage pool '{name}' created and activated at '{target_path}'.")
+        _remember_pool(conn, name, defined_pool)
+        return defined_pool  # Return the newly created and active pool
+
+    except libvirt.libvirtError as create_e:
+        log.error(f"Failed to define, build, or activate pool '{name}': {create_e}")
+        # Attempt cleanup on failure
+        with contextlib.suppress(libvirt.libvirtError):
+            if defined_pool:
+                log.info(f"Attempting to undefine failed pool '{name}'...")
+                defined_pool.undefine()
+        msg = f"Failed to create pool '{name}'"
+        raise RuntimeError(msg) from create_e
+
+
+def _define_volume(
+    pool: libvirt.virStoragePool,
+    vol_name: str,
+    capacity: int,
+    fmt: str,
+    group_id: str,
+) -> libvirt.virStorageVol:
+    """
+    Creates an empty volume of capacity bytes, ready to be uploaded into.
+
+    Raises:
+        RuntimeError: If libvirt returns no volume.
+        libvirt.libvirtError: For underlying libvirt API errors.
+    """
+    vol_xml_desc = render_xml(
+        _VOL_XML_TMPL,
+        name=vol_name,
+        capacity=capacity,
+        fmt=fmt,
+        group_id=group_id,
+    )
+    log.info(f"Defining volume '{vol_name}'...")
+    log.debug(f"Volume '{vol_name}' XML:\n{vol_xml_desc}")
+    created_vol = pool.createXML(vol_xml_desc, 0)
+    if created_vol is None:
+        msg = f"Failed to define volume '{vol_name}' in pool '{pool.name()}' (createXML returned None)."
+        log.error(msg)
+        raise RuntimeError(msg)
+    log.info(
+        f"Volume '{vol_name}' defined (Path: {created_vol.path()}). Uploading content..."
+    )
+    return created_vol
+
+
+def _stream_url_into_volume(
+    conn: libvirt.virConnect,
+    pool: libvirt.virStoragePool,
+    host: str,
+    vol_name: str,
+    source_file: Path,
+    fmt: str,
+    base_image_url: str,
+    base_image_checksum: str | None,
+    ssh_key: Path | None,
+) -> libvirt.virStorageVol | None:
+    """
+    Creates the volume by uploading base_image_url while it downloads, instead
+    of downloading it to source_file first and reading it back for the upload.
+    source_file is still written along the way, serving later deploys.
+
+    Returns:
+        The uploaded volume, or None if source_file has appeared in the meantime
+        or the download has no Content-Length to size the volume with; the
+        caller then uploads from source_file as usual.
+    Raises:
+        See ensure_volume_from_file.
+    """
+    with download_lock(source_file):
+        if source_file.exists() or partial_path(source_file).exists():
+            return None  # Downloaded concurrently, or there is a download to resume
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            group_id_future = executor.submit(get_group_id, host, ssh_key)
+            log.info(f"Opening {base_image_url}...")
+            response, total_size = open_url(base_image_url)
+        if total_size <= 0:
+            log.info("Download size unknown, downloading before uploading.")
+            response.close()
+            return None
+
+        log.info(
+            f"Streaming {base_image_url} ({total_size} bytes) into volume '{vol_name}' "
+            f"in pool '{pool.name()}', keeping a copy at {source_file}..."
+        )
+        partial = partial_path(source_file)
+        created_vol: libvirt.virStorageVol | None = None
+        stream: libvirt.virStream | None = None
+        try:
+            with response, partial.open("wb") as f:
+                created_vol = _define_volume(
+                    pool, vol_name, total_size, fmt, group_id_future.result()
                 )
-                return defined_pool  # Return the newly created and active pool
+                source = _DownloadStreamSource(
+                    response, total_size, f, hashlib.sha256()
+                )
+                stream = conn.newStream(0)
+                created_vol.upload(stream, 0, total_size, 0)
+                # libvirt drives the send loop and aborts the stream if a callback raises
+                stream.sendAll(source.read, None)
 
-            except libvirt.libvirtError as create_e:
-                log.error(
-                    f"Failed to define, build, or activate pool '{name}': {create_e}",
-                    exc_info=True,
+            if source.sent_bytes != total_size:
+                msg = (
+                    f"Download of {base_image_url} ended after {source.sent_bytes} "
+                    f"of {total_size} bytes"
                 )
-                # Attempt cleanup on failure
-                with contextlib.suppress(libvirt.libvirtError):
-                    if defined_pool:
-                        log.info(f"Attempting to undefine failed pool '{name}'...")
-                        defined_pool.undefine()
-                msg = f"Failed to create pool '{name}'"
-                raise RuntimeError(msg) from create_e
-        else:
-            # Error during initial lookup that wasn't NO_STORAGE_POOL
-            log.error(f"Error looking up pool '{name}': {e}", exc_info=True)
-            msg = f"Failed to look up storage pool '{name}'"
+                raise OSError(msg)
+            if base_image_checksum:
+                check_checksum(
+                    source_file, source.hasher.hexdigest(), base_image_checksum
+                )
+
+            log.debug("Finishing upload stream...")
+            ret = stream.finish()
+            if ret == -1:
+                # Finish failed after all data supposedly sent
+                log.error(f"Error finishing stream for volume '{vol_name}'.")
+                msg = f"Stream finish error for volume '{vol_name}'"
+                raise RuntimeError(msg)
+            partial.replace(source_file)
+
+            print(f"\nVolume '{vol_name}' created and uploaded successfully.")
+            _remember_volume(pool, created_vol)
+            return created_vol
+
+        except ValueError:
+            # Checksum mismatch, neither the volume nor the download are usable
+            _discard_volume_upload(vol_name, created_vol, stream)
+            discard_partial(source_file)
+            raise
+        except (libvirt.libvirtError, OSError, RemoteCommandError, RuntimeError) as e:
+            log.error(
+                f"Failed to stream {base_image_url} into volume '{vol_name}': {e}"
+            )
+            _discard_volume_upload(vol_name, created_vol, stream)
+            discard_partial(source_file)
+            msg = f"Failed to ensure volume '{vol_name}' exists"
+            raise RuntimeError(msg) from e
+        except Exception as e:
+            log.exception(
+                f"An unexpected error occurred streaming into volume '{vol_name}'"
+            )
+            _discard_volume_upload(vol_name, created_vol, stream)
+            discard_partial(source_file)
+            msg = f"Unexpected error ensuring volume '{vol_name}'"
             raise RuntimeError(msg) from e
 
 
+def _discard_volume_upload(
+    vol_name: str,
+    created_vol: libvirt.virStorageVol | None,
+    stream: libvirt.virStream | None,
+) -> None:
+    """Best effort removal of a volume whose upload failed."""
+    with contextlib.suppress(libvirt.libvirtError):
+        if stream:
+            stream.abort()
+    with contextlib.suppress(libvirt.libvirtError):
+        if created_vol:
+            log.info(f"Attempting to delete partially uploaded volume '{vol_name}'...")
+            created_vol.delete(0)
+
+
 def ensure_volume_from_file(
     conn: libvirt.virConnect,
     pool: libvirt.virStoragePool,
@@ -160,143 +759,197 @@ def ensure_volume_from_file(
     Raises:
         RuntimeError: If the volume cannot be found, created, or uploaded, or if download fails.
         libvirt.libvirtError: For underlying libvirt API errors.
-        FileNotFoundError: If the source file cannot be found after download attempt.
         ValueError: If checksum verification fails.
         RemoteCommandError: If getting remote group ID fails.
     """
     pool_name = pool.name()
-    vol: libvirt.virStorageVol | None = None
     try:
         log.info(f"Looking up volume '{vol_name}' in pool '{pool_name}'...")
-        vol = pool.storageVolLookupByName(vol_name)
-        log.info(
-            f"Found existing volume '{vol_name}' in pool '{pool_name}'. Path: {vol.path()}"
-        )
-        # Optional: Add check here if existing volume needs verification (e.g., size, checksum)
-        return vol
+        vol = lookup_volume(pool, vol_name)
+        if vol is not None:
+            log.info(
+                f"Found existing volume '{vol_name}' in pool '{pool_name}'. Path: {vol.path()}"
+            )
+            # Optional: Add check here if existing volume needs verification (e.g., size, checksum)
+            return vol
     except libvirt.libvirtError as e:
-        if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
-            log.error(f"Error looking up volume '{vol_name}': {e}", exc_info=True)
-            msg = f"Failed to look up volume '{vol_name}'"
-            raise RuntimeError(msg) from e
-        # Volume doesn't exist, proceed to create/upload
-        log.info(f"Volume '{vol_name}' not found. Will create/upload.")
+        log.error(f"Error looking up volume '{vol_name}': {e}")
+        msg = f"Failed to look up volume '{vol_name}'"
+        raise RuntimeError(msg) from e
+    # Volume doesn't exist, proceed to create/upload
+    log.info(f"Volume '{vol_name}' not found. Will create/upload.")
 
-    # 1. Ensure Base Image is downloaded locally first
+    # Over a remote connection a fresh download is sent on while it arrives,
+    # rather than waiting for it to be complete and then reading it back.
+    # An interrupted earlier download is resumed by download_file instead.
+    if (
+        not is_local_connection(conn)
+        and not source_file.exists()
+        and not partial_path(source_file).exists()
+    ):
+        vol = _stream_url_into_volume(
+            conn,
+            pool,
+            host,
+            vol_name,
+            source_file,
+            fmt,
+            base_image_url,
+            base_image_checksum,
+            ssh_key,
+        )
+        if vol is not None:
+            return vol
+
+    # 1. Ensure Base Image is downloaded locally first. The remote group ID
+    # needed for the volume permissions is fetched over SSH in the meantime.
     log.info(f"Ensuring base image exists locally at {source_file}...")
-    # download_file will raise exceptions on failure (network, disk space, checksum)
-    download_file(base_image_url, source_file, base_image_checksum)
+    cached = source_file.exists()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        group_id_future = executor.submit(get_group_id, host, ssh_key)
+        # download_file will raise exceptions on failure (network, disk space, checksum)
+        # An existing file is verified while uploading it instead of reading it twice
+        file_size_bytes = download_file(
+            base_image_url, source_file, base_image_checksum, verify_existing=False
+        )
     log.info(f"Base image is available at {source_file}.")
 
-    # 2. Check if source file exists *after* download attempt
-    if not source_file.is_file():
-        msg = f"Source file {source_file} not found or is not a file, even after download attempt."
-        log.error(msg)
-        raise FileNotFoundError(msg)
+    try:
+        group_id = group_id_future.result()  # Get group ID for permissions
+    except RemoteCommandError as e:
+        log.error(f"Failed to get the remote group ID for volume '{vol_name}': {e}")
+        msg = f"Failed to ensure volume '{vol_name}' exists"
+        raise RuntimeError(msg) from e
 
-    # 3. Create and Upload
+    # 2. Create and Upload
+    try:
+        return upload_volume_from_file(
+            conn,
+            pool,
+            vol_name,
+            source_file,
+            file_size_bytes,
+            fmt,
+            group_id,
+            base_image_checksum,
+        )
+    except ValueError:
+        if not cached:
+            raise
+        # The cached image was only verified while uploading it and has been
+        # deleted by now, fetch it again (verified on the fly) and retry once
+        log.warning(f"Cached {source_file} is corrupt, downloading it again...")
+    file_size_bytes = download_file(base_image_url, source_file, base_image_checksum)
+    return upload_volume_from_file(
+        conn, pool, vol_name, source_file, file_size_bytes, fmt, group_id
+    )
+
+
+def upload_volume_from_file(
+    conn: libvirt.virConnect,
+    pool: libvirt.virStoragePool,
+    vol_name: str,
+    source_file: Path,
+    file_size_bytes: int,
+    fmt: str,
+    group_id: str,
+    checksum: str | None = None,
+) -> libvirt.virStorageVol:
+    """
+    Creates a new volume in the pool and uploads the local source_file into it,
+    verifying the uploaded content against checksum if one is given.
+
+    Returns:
+        The libvirt.virStorageVol object for the volume.
+    Raises:
+        RuntimeError: If the volume cannot be created or uploaded.
+        ValueError: If checksum verification fails, source_file is deleted then.
+    """
+    pool_name = pool.name()
     log.info(
         f"Creating volume '{vol_name}' in pool '{pool_name}' from {source_file}..."
     )
     created_vol: libvirt.virStorageVol | None = None
     stream: libvirt.virStream | None = None
     try:
-        file_size_bytes = source_file.stat().st_size
         log.info(f"Source file size: {file_size_bytes} bytes")
-        group_id = get_group_id(host, ssh_key)  # Get group ID for permissions
-
-        # Define volume metadata
-        vol_xml_desc = f"""
-        <volume type='file'>
-          <name>{vol_name}</name>
-          <capacity unit='bytes'>{file_size_bytes}</capacity>
-          <target>
-            <format type='{fmt}'/>
-             <permissions>
-               <mode>0644</mode>
-               <owner>0</owner>
-               <group>{group_id}</group>
-             </permissions>
-          </target>
-        </volume>
-        """
-        log.info(f"Defining volume '{vol_name}' with XML:\n{vol_xml_desc}")
-        created_vol = pool.createXML(vol_xml_desc, 0)
-        if created_vol is None:
-            msg = f"Failed to define volume '{vol_name}' in pool '{pool_name}' (createXML returned None)."
-            log.error(msg)
-            raise RuntimeError(msg)
-
-        log.info(
-            f"Volume '{vol_name}' defined (Path: {created_vol.path()}). Uploading content..."
-        )
+        created_vol = _define_volume(pool, vol_name, file_size_bytes, fmt, group_id)
 
-        # Upload the content via stream
-        stream = conn.newStream(0)  # flags=0 for non-sparse
-        created_vol.upload(stream, 0, file_size_bytes, 0)
-
-        uploaded_bytes = 0
-        start_time = time.time()
         with source_file.open("rb") as f:
-            while True:
-                chunk = f.read(1024 * 1024)  # 1MB chunk
-                if not chunk:
-                    break
-                # stream.sendall is preferable if available and works for your libvirt version
+            hasher = hashlib.sha256() if checksum else None
+            if is_local_connection(conn) and copy_into_local_volume(
+                f.fileno(), Path(created_vol.path()), file_size_bytes
+            ):
+                log.info(f"Copied {source_file} into volume '{vol_name}' in-kernel.")
+                # libvirt didn't see the write, let it re-read capacity/allocation
+                refresh_pool(pool)
+                if hasher is not None:
+                    # The data never passed through us, hash the source on its own
+                    hasher = sha256_file(f)
+            else:
+                # Upload the content via a sparse stream, holes in the source file
+                # are sent as hole markers instead of runs of zero bytes
+                source = _FileStreamSource(f.fileno(), file_size_bytes, hasher)
+                stream = conn.newStream(0)
                 try:
-                    ret = stream.send(chunk)
-                    if ret == -1:
-                        # Error detail retrieval might vary or not work depending on stream state
-                        # stream.finish() might give error details but might also block or fail
-                        # Abort is generally safer if send failed midway
-                        log.error(
-                            f"Error sending data to stream for volume '{vol_name}'. Aborting."
-                        )
-                        stream.abort()
-                        msg = f"Stream send error for volume '{vol_name}'"
-                        raise RuntimeError(msg)
-                except libvirt.libvirtError as send_e:
-                    log.error(
-                        f"Libvirt error during stream send for volume '{vol_name}': {send_e}",
-                        exc_info=True,
+                    created_vol.upload(
+                        stream,
+                        0,
+                        file_size_bytes,
+                        libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM,
                     )
-                    stream.abort()  # Ensure abort on libvirt error too
-                    msg = f"Stream send libvirt error for volume '{vol_name}'"
-                    raise RuntimeError(msg) from send_e
-
-                uploaded_bytes += len(chunk)
-                # Progress reporting (optional)
-                elapsed_time = time.time() - start_time
-                speed = (
-                    (uploaded_bytes / elapsed_time / 1024 / 1024)
-                    if elapsed_time > 0
-                    else 0.0
-                )
-                percent = (
-                    (uploaded_bytes / file_size_bytes) * 100
-                    if file_size_bytes > 0
-                    else 0.0
-                )
-                print(
-                    f"\r  Uploaded {uploaded_bytes / 1024 / 1024:.2f} / {file_size_bytes / 1024 / 1024:.2f} MB"
-                    f" ({percent:.1f}%) at {speed:.2f} MB/s",
-                    end="",
-                    flush=True,
-                )
+                    sparse = True
+                except libvirt.libvirtError as sparse_e:
+                    log.warning(
+                        f"Sparse upload not supported for volume '{vol_name}' ({sparse_e}), "
+                        "falling back to a regular stream."
+                    )
+                    with contextlib.suppress(libvirt.libvirtError):
+                        stream.abort()
+                    stream = conn.newStream(0)
+                    created_vol.upload(stream, 0, file_size_bytes, 0)
+                    sparse = False
 
-        log.debug("Finishing upload stream...")
-        ret = stream.finish()
-        if ret == -1:
-            # Finish failed after all data supposedly sent
-            log.error(f"Error finishing stream for volume '{vol_name}'.")
-            msg = f"Stream finish error for volume '{vol_name}'"
-            raise RuntimeError(msg)
+                # libvirt drives the send loop and aborts the stream if a callback raises
+                if sparse:
+                    stream.sparseSendAll(source.read, source.hole, source.skip, None)
+                else:
+                    stream.sendAll(source.read, None)
+
+        if hasher is not None and checksum:
+            try:
+                check_checksum(source_file, hasher.hexdigest(), checksum)
+            except ValueError:
+                # Drop the bad local copy, the next run downloads it again
+                with contextlib.suppress(OSError):
+                    source_file.unlink()
+                raise
+
+        if stream is not None:
+            log.debug("Finishing upload stream...")
+            ret = stream.finish()
+            if ret == -1:
+                # Finish failed after all data supposedly sent
+                log.error(f"Error finishing stream for volume '{vol_name}'.")
+                msg = f"Stream finish error for volume '{vol_name}'"
+                raise RuntimeError(msg)
 
         print(f"\nVolume '{vol_name}' created and uploaded successfully.")
+        _remember_volume(pool, created_vol)
         return created_vol
 
-    except (libvirt.libvirtError, OSError, RemoteCommandError) as e:
-        log.error(f"Failed to create or upload volume '{vol_name}': {e}", exc_info=True)
+    except ValueError:
+        # Checksum mismatch, the uploaded content is unusable
+        with contextlib.suppress(libvirt.libvirtError):
+            if stream:
+                stream.abort()
+        with contextlib.suppress(libvirt.libvirtError):
+            if created_vol:
+                log.info(f"Deleting volume '{vol_name}' with mismatching content...")
+                created_vol.delete(0)
+        raise
+    except (libvirt.libvirtError, OSError) as e:
+        log.error(f"Failed to create or upload volume '{vol_name}': {e}")
         # Attempt cleanup on failure
         with contextlib.suppress(libvirt.libvirtError):
             if stream:
@@ -323,6 +976,11 @@ def ensure_volume_from_file(
         raise RuntimeError(msg) from e
 
 
+# Markers printed by the remote clone script, see create_linked_clone_disk
+_CLONE_EXISTS = "VM_SPAWNER_CLONE_EXISTS"
+_CLONE_CREATED = "VM_SPAWNER_CLONE_CREATED"
+
+
 def create_linked_clone_disk(
     storage_pool: libvirt.virStoragePool,
     remote_host: str,
@@ -356,73 +1014,57 @@ def create_linked_clone_disk(
         log.info(f"Base volume path: {remote_src}")
         log.info(f"Target clone disk path: {remote_dst}")
 
-        # Check if clone disk already exists remotely using 'test -f'
-        check_disk_cmd = ["test", "-f", str(remote_dst)]
-        log.info(
-            f"Checking if remote clone disk exists: {' '.join(map(shlex.quote, check_disk_cmd))}"
-        )
-        try:
-            check_result = run_remote_command(
-                remote_host,
-                check_disk_cmd,
-                check=False,  # Don't raise on non-zero exit code
-                ssh_key=ssh_key,
-                timeout=30,
-            )
-            if check_result.returncode == 0:
-                log.info(
-                    f"Remote clone disk {remote_dst} already exists. Skipping creation."
-                )
-                # Refresh pool just in case libvirt doesn't know about it yet
-                log.info(f"Refreshing pool '{storage_pool.name()}'...")
-                storage_pool.refresh(0)
-                return remote_dst  # Return path to existing clone
-            if check_result.returncode == 1:
-                log.info("Remote clone disk does not exist. Creating...")
-                # Proceed to create
-            else:
-                # Unexpected return code from 'test'
-                msg = "'test -f' command failed unexpectedly"
-                raise RemoteCommandError(
-                    msg,
-                    command=check_disk_cmd,
-                    returncode=check_result.returncode,
-                    stderr=check_result.stderr,
-                )
-        except (subprocess.TimeoutExpired, FileNotFoundError) as e:
-            msg = f"Failed to check for existing clone disk: {e}"
-            raise RemoteCommandError(msg, command=check_disk_cmd) from e
-
-        # Create the linked clone using qemu-img via run_remote_command
+        # Create the linked clone using qemu-img, unless it already exists.
+        # Probe and create run in one remote shell to save an SSH round trip.
         qemu_img_cmd = [
             "qemu-img",
             "create",
             "-f",
             "qcow2",
-            "-F",
-            "qcow2",  # Assume backing file format is qcow2
+            "-o",
+            qcow2_clone_options(remote_host, ssh_key),  # Backing format is qcow2
             "-b",
             str(remote_src),  # Backing file path
             str(remote_dst),  # New clone path
         ]
+        clone_script = (
+            f"if test -f {shlex.quote(str(remote_dst))}; then echo {_CLONE_EXISTS}; "
+            f"else {shlex.join(qemu_img_cmd)} && echo {_CLONE_CREATED}; fi"
+        )
         # run_remote_command will raise RemoteCommandError on failure
-        run_remote_command(
-            remote_host, qemu_img_cmd, timeout=120, ssh_key=ssh_key
-        )  # Increased timeout for image creation
-
-        log.info(f"Linked clone disk created successfully at {remote_dst}.")
-        log.info(
-            f"Refreshing pool '{storage_pool.name()}' after creating clone disk..."
+        result = run_remote_command(
+            remote_host,
+            [shlex.join(["sh", "-c", clone_script])],
+            timeout=120,  # Increased timeout for image creation
+            ssh_key=ssh_key,
         )
-        storage_pool.refresh(0)  # Refresh pool so libvirt sees the new file
+        status = result.stdout.splitlines()[-1] if result.stdout else ""
+
+        if status == _CLONE_EXISTS:
+            # Nothing changed on disk, libvirt picked the file up when it was created
+            log.info(
+                f"Remote clone disk {remote_dst} already exists. Skipping creation."
+            )
+        elif status == _CLONE_CREATED:
+            log.info(f"Linked clone disk created successfully at {remote_dst}.")
+            log.info(
+                f"Refreshing pool '{storage_pool.name()}' after creating clone disk..."
+            )
+            refresh_pool(storage_pool)  # Refresh pool so libvirt sees the new file
+        else:
+            msg = "Linked clone command finished without reporting its outcome"
+            raise RemoteCommandError(
+                msg,
+                command=["sh", "-c", clone_script],
+                returncode=result.returncode,
+                stdout=result.stdout,
+                stderr=result.stderr,
+            )
 
         return remote_dst
 
     except libvirt.libvirtError as e:
-        log.error(
-            f"Libvirt error during clone disk creation or pool refresh: {e}",
-            exc_info=True,
-        )
+        log.error(f"Libvirt error during clone disk creation or pool refresh: {e}")
         msg = "Libvirt operation failed during linked clone creation"
         raise RuntimeError(msg) from e
     except RemoteCommandError as e:
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
-# ruff: noqa: TRY301 TRY300
+# ruff: noqa: TRY300
 
 import logging
 import sys
 import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from .connect import connect_libvirt
+
+from .connect import get_conn
+from .create import forget_cached_lookups
+from .seed import seed_volume_name
 
 # Assume libvirt is available
 try:
@@ -19,14 +23,79 @@ except ImportError:
     )
     sys.exit(1)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 log = logging.getLogger(__name__)
 
+# How long, and how often at first, to check that a destroyed domain stopped
+DESTROY_SETTLE_TIMEOUT = 2.0
+DESTROY_POLL_MIN_DELAY = 0.05
+
+# Runs the volume deletes of delete_vm(async_volumes=True)
+_background_deleter = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="vm_spawner-delete"
+)
+
+# Sources of the domain's actual disks. Of its CD-ROMs, only the cloud-init
+# seed volume created for the domain is deleted, see seed_volume_name
+_DISK_SOURCE_PATH = "./devices/disk[@device='disk']/source"
+_CDROM_SOURCE_PATH = "./devices/disk[@device='cdrom']/source"
+
+
+def _wait_until_inactive(dom: libvirt.virDomain) -> None:
+    """
+    Polls with exponential backoff until dom is no longer active, for at most
+    DESTROY_SETTLE_TIMEOUT seconds. destroy() normally returns only after the
+    domain has stopped, so the first check usually succeeds right away.
+    """
+    deadline = time.monotonic() + DESTROY_SETTLE_TIMEOUT
+    delay = DESTROY_POLL_MIN_DELAY
+    while dom.isActive():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            log.warning(
+                f"Domain {dom.name()} still active {DESTROY_SETTLE_TIMEOUT}s after destroy."
+            )
+            return
+        time.sleep(min(delay, remaining))
+        delay *= 2
+
+
+def _delete_volumes(volumes: list[libvirt.virStorageVol]) -> None:
+    """Deletes volumes, logging instead of raising errors."""
+    # Each delete blocks until the host has removed the file, run them
+    # concurrently over the shared connection
+    with ThreadPoolExecutor(max_workers=min(10, len(volumes))) as executor:
+        # Consume the results so unexpected errors still propagate
+        list(executor.map(_delete_volume, volumes))
+    # Cached volume listings may still hold the deleted volumes
+    forget_cached_lookups()
+
+
+def _delete_volume(vol: libvirt.virStorageVol) -> None:
+    """Deletes vol, logging instead of raising errors."""
+    vol_name = vol.name()  # Get name before potential deletion invalidates object
+    vol_path: str | None = None
+    try:
+        vol_path = vol.path()
+        log.info(f"Deleting storage volume: {vol_name} (Path: {vol_path})...")
+        # Use flags=0 for standard delete. Add flags if needed (e.g., snapshots).
+        vol.delete(0)
+        log.info(f"Successfully deleted storage volume: {vol_name}")
+    except libvirt.libvirtError as e_del:
+        # Log deletion errors but don't raise an exception here,
+        # as the domain is already undefined.
+        log.error(
+            f"Failed to delete storage volume {vol_name} ({vol_path}): {e_del}",
+            exc_info=False,
+        )
 
-def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
+
+def delete_vm(
+    host: str,
+    domain_name: str,
+    ssh_key: Path | None = None,
+    *,
+    async_volumes: bool = False,
+) -> Future[None] | None:
     """
     Connects to libvirt, deletes the specified domain (VM), and attempts
     to delete its associated storage volumes (disks identified in XML).
@@ -34,7 +103,12 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
     Args:
         host: The user@host string for libvirt connection.
         domain_name: The name of the domain (VM) to delete.
+        async_volumes: Return as soon as the domain is undefined, deleting
+                       its volumes (the slow part) in a background thread.
 
+    Returns:
+        With async_volumes, a future completing once the volumes are deleted,
+        if there were any. The process waits for it before exiting.
     Raises:
         libvirt.libvirtError: If connection fails or critical libvirt
                               operations encounter unexpected errors (e.g., cannot
@@ -47,14 +121,13 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
         libvirt_uri = f"qemu+ssh://{host}/system?keyfile={ssh_key}"
     else:
         libvirt_uri = f"qemu+ssh://{host}/system"
-    conn: libvirt.virConnect | None = None
     dom: libvirt.virDomain | None = None
     disk_paths: list[str] = []
     pool_and_vol_names: list[tuple[str, str]] = []  # Store (pool_name, vol_name)
 
     try:
         log.info(f"Attempting deletion of VM: {domain_name} via {libvirt_uri}")
-        conn = connect_libvirt(libvirt_uri)  # Raises on connection failure
+        conn = get_conn(libvirt_uri)  # Raises on connection failure
 
         # --- 1. Find the Domain ---
         try:
@@ -66,7 +139,7 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
                 log.warning(
                     f"Domain {domain_name} not found. Assuming already deleted."
                 )
-                return  # Nothing more to do
+                return None  # Nothing more to do
             log.error(f"Error looking up domain {domain_name}: {e}", exc_info=True)
             raise  # Reraise unexpected lookup errors
 
@@ -77,7 +150,7 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
             )
             try:
                 dom.destroy()
-                time.sleep(2)  # Give time for resources to release
+                _wait_until_inactive(dom)
                 log.info(f"Domain {domain_name} destroyed.")
             except libvirt.libvirtError as e:
                 log.error(f"Failed to destroy domain {domain_name}: {e}", exc_info=True)
@@ -90,31 +163,32 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
             log.info(f"Retrieving XML description for {domain_name} to find disks...")
             xml_desc = dom.XMLDesc(0)
             root = ET.fromstring(xml_desc)
-            devices = root.find("devices")
-            if devices is not None:
-                for disk in devices.findall("disk"):
-                    if disk.get("device") == "disk":  # Look for actual disks
-                        source = disk.find("source")
-                        if source is not None:
-                            # Prefer volume/pool info if available (more reliable for deletion)
-                            pool_name = source.get("pool")
-                            vol_name = source.get("volume")
-                            file_path = source.get("file")  # Fallback: path
-
-                            if pool_name and vol_name:
-                                log.info(
-                                    f"Found managed disk: pool='{pool_name}', volume='{vol_name}'"
-                                )
-                                pool_and_vol_names.append((pool_name, vol_name))
-                            elif file_path:
-                                log.info(
-                                    f"Found disk by path (will attempt lookup): {file_path}"
-                                )
-                                disk_paths.append(file_path)
-                            else:
-                                log.warning(
-                                    "Disk source found without pool/volume or file path."
-                                )
+            seed_name = seed_volume_name(domain_name)
+            sources = [
+                *root.iterfind(_DISK_SOURCE_PATH),
+                # An installer or shared ISO attached to the domain stays
+                *(
+                    source
+                    for source in root.iterfind(_CDROM_SOURCE_PATH)
+                    if source.get("volume") == seed_name
+                ),
+            ]
+            for source in sources:
+                # Prefer volume/pool info if available (more reliable for deletion)
+                pool_name = source.get("pool")
+                vol_name = source.get("volume")
+                file_path = source.get("file")  # Fallback: path
+
+                if pool_name and vol_name:
+                    log.info(
+                        f"Found managed disk: pool='{pool_name}', volume='{vol_name}'"
+                    )
+                    pool_and_vol_names.append((pool_name, vol_name))
+                elif file_path:
+                    log.info(f"Found disk by path (will attempt lookup): {file_path}")
+                    disk_paths.append(file_path)
+                else:
+                    log.warning("Disk source found without pool/volume or file path.")
         except Exception as e:
             log.error(
                 f"Error parsing XML or finding disks for {domain_name}: {e}",
@@ -141,16 +215,23 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
 
         # --- 5. Delete Associated Storage Volumes ---
         volumes_to_delete: list[libvirt.virStorageVol] = []
+        # Keys of volumes_to_delete, key() is answered from the local object
+        volume_keys: set[str] = set()
 
-        # Find volumes by pool/name
+        # Find volumes by pool/name, looking up each pool once
+        pools: dict[str, libvirt.virStoragePool] = {}
         for pool_name, vol_name in pool_and_vol_names:
             try:
-                pool = conn.storagePoolLookupByName(pool_name)
+                pool = pools.get(pool_name)
+                if pool is None:
+                    pool = pools[pool_name] = conn.storagePoolLookupByName(pool_name)
                 vol = pool.storageVolLookupByName(vol_name)
                 log.info(
                     f"Found volume '{vol_name}' in pool '{pool_name}' for deletion."
                 )
-                volumes_to_delete.append(vol)
+                if vol.key() not in volume_keys:
+                    volume_keys.add(vol.key())
+                    volumes_to_delete.append(vol)
             except libvirt.libvirtError as e:
                 log.warning(
                     f"Could not find volume '{vol_name}' in pool '{pool_name}' for deletion: {e}"
@@ -161,10 +242,11 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
             try:
                 vol = conn.storageVolLookupByPath(path)
                 # Avoid adding duplicates if found by path and pool/name
-                if vol and vol not in volumes_to_delete:
+                if vol and vol.key() not in volume_keys:
                     log.info(
                         f"Found volume by path '{path}' (Name: {vol.name()}) for deletion."
                     )
+                    volume_keys.add(vol.key())
                     volumes_to_delete.append(vol)
             except libvirt.libvirtError as e:
                 if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_VOL:
@@ -181,27 +263,15 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
             log.info(
                 f"Attempting to delete {len(volumes_to_delete)} associated storage volume(s)..."
             )
-            for vol in volumes_to_delete:
-                try:
-                    vol_name = (
-                        vol.name()
-                    )  # Get name before potential deletion invalidates object
-                    vol_path = vol.path()
-                    log.info(
-                        f"Deleting storage volume: {vol_name} (Path: {vol_path})..."
-                    )
-                    # Use flags=0 for standard delete. Add flags if needed (e.g., snapshots).
-                    vol.delete(0)
-                    log.info(f"Successfully deleted storage volume: {vol_name}")
-                except libvirt.libvirtError as e_del:
-                    # Log deletion errors but don't raise an exception here,
-                    # as the domain is already undefined.
-                    log.error(
-                        f"Failed to delete storage volume {vol_name} ({vol_path}): {e_del}",
-                        exc_info=False,
-                    )
+            if async_volumes:
+                log.info(
+                    f"VM '{domain_name}' undefined, its volumes are deleted in the background."
+                )
+                return _background_deleter.submit(_delete_volumes, volumes_to_delete)
+            _delete_volumes(volumes_to_delete)
 
         log.info(f"VM '{domain_name}' deletion process completed.")
+        return None
 
     except (libvirt.libvirtError, RuntimeError) as e:
         log.error(f"VM deletion failed for {domain_name}: {e}", exc_info=True)
@@ -213,15 +283,9 @@ def delete_vm(host: str, domain_name: str, ssh_key: Path | None = None) -> None:
         msg = f"Unexpected error deleting VM {domain_name}"
         raise RuntimeError(msg) from e
     finally:
-        # --- 6. Close Connection ---
+        # --- 6. Sanity Check (the shared connection is closed at exit) ---
         if dom is not None:
             # This shouldn't happen if undefine was successful
             log.warning(
                 f"Domain object for '{domain_name}' still exists after deletion attempt."
             )
-        if conn is not None:
-            try:
-                conn.close()
-                log.info("Libvirt connection closed.")
-            except libvirt.libvirtError as e:
-                log.warning(f"Error closing libvirt connection: {e}", exc_info=False)
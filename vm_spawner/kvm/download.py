@@ -1,19 +1,57 @@
 # ruff: noqa: TRY301 TRY300
 
 import contextlib
+import fcntl
 import hashlib
+import http.client
+import io
 import logging
+import os
 import time
 import urllib.error
 import urllib.request
+from collections.abc import Iterator
 from pathlib import Path
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 log = logging.getLogger(__name__)
 
+# Minimum seconds between two progress lines while downloading or uploading
+PROGRESS_INTERVAL = 0.5
+
+# Bytes read from the response and written per download loop iteration
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def check_checksum(file_path: Path, calculated: str, expected: str) -> None:
+    """
+    Compares an already calculated SHA256 hex digest of file_path against expected.
+
+    Raises:
+        ValueError: If the checksum does not match.
+    """
+    expected_lower = expected.lower()
+    if calculated == expected_lower:
+        log.info(f"Checksum OK: {calculated}")
+    else:
+        msg = (
+            f"Checksum mismatch for {file_path}!\n"
+            f"  Expected: {expected_lower}\n"
+            f"  Got:      {calculated}"
+        )
+        log.error(msg)
+        raise ValueError(msg)
+
+
+def sha256_file(f: io.BufferedReader | io.FileIO) -> "hashlib._Hash":
+    """
+    Returns the SHA256 of the open file f from its current position on.
+    file_digest hashes straight from the file buffer with the GIL released,
+    and the kernel is told to read ahead aggressively.
+    """
+    if hasattr(os, "posix_fadvise"):  # Not available on macOS
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return hashlib.file_digest(f, "sha256")
+
 
 def _verify_checksum(file_path: Path, expected_checksum: str) -> None:
     """
@@ -25,40 +63,119 @@ def _verify_checksum(file_path: Path, expected_checksum: str) -> None:
         ValueError: If the checksum does not match.
     """
     log.info(f"Verifying SHA256 checksum for {file_path}...")
-    hasher = hashlib.sha256()
     try:
-        with file_path.open("rb") as f:
-            while True:
-                chunk = f.read(65536)  # Read in 64k chunks
-                if not chunk:
-                    break
-                hasher.update(chunk)
-        calculated_checksum = hasher.hexdigest()
-        expected_lower = expected_checksum.lower()
-        if calculated_checksum == expected_lower:
-            log.info(f"Checksum OK: {calculated_checksum}")
-        else:
-            msg = (
-                f"Checksum mismatch for {file_path}!\n"
-                f"  Expected: {expected_lower}\n"
-                f"  Got:      {calculated_checksum}"
-            )
-            log.error(msg)
-            raise ValueError(msg)
+        # Unbuffered, the hash reads large blocks itself
+        with file_path.open("rb", buffering=0) as f:
+            calculated_checksum = sha256_file(f).hexdigest()
+        check_checksum(file_path, calculated_checksum, expected_checksum)
     except FileNotFoundError:
         log.error(f"File not found for checksum verification: {file_path}")
         raise
     except OSError as e:
-        log.error(f"Error reading file {file_path} for checksum: {e}", exc_info=True)
+        log.error(f"Error reading file {file_path} for checksum: {e}")
         msg = f"Could not read file {file_path} for checksum"
         raise RuntimeError(msg) from e
 
 
-def download_file(url: str, destination: Path, checksum: str | None = None) -> None:
+@contextlib.contextmanager
+def _exclusive_lock(lock_path: Path) -> Iterator[None]:
+    """Holds an exclusive flock on lock_path, blocking until it is available."""
+    with lock_path.open("a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def partial_path(destination: Path) -> Path:
+    """Where a download to destination is written until it is complete."""
+    return destination.with_name(f"{destination.name}.part")
+
+
+def discard_partial(destination: Path) -> None:
+    """Removes the unfinished download to destination, if there is one."""
+    with contextlib.suppress(OSError):
+        partial_path(destination).unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def download_lock(destination: Path) -> Iterator[None]:
+    """
+    Serializes everyone creating the file at destination (e.g. by downloading
+    it) across processes, via a lock file next to it.
+    """
+    # Ensure parent directory exists
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with _exclusive_lock(destination.with_name(f"{destination.name}.lock")):
+        yield
+
+
+def open_url(url: str, offset: int = 0) -> tuple[http.client.HTTPResponse, int]:
+    """
+    Opens url for downloading, the caller has to close the response.
+    With an offset, the server is asked for the content from there on; it
+    answered with just that if the response status is 206.
+
+    Returns:
+        The response and its Content-Length, 0 if unknown.
+    Raises:
+        urllib.error.URLError: For network errors.
+        urllib.error.HTTPError: For HTTP errors (like 404).
+    """
+    headers = {"User-Agent": "vm-spawner/1.0"}  # More specific agent
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        response: http.client.HTTPResponse = urllib.request.urlopen(req, timeout=300)
+    except urllib.error.HTTPError as e:
+        if not offset or e.code != 416:  # Range Not Satisfiable
+            raise
+        e.close()
+        # The partial content doesn't fit the resource (anymore), start over
+        log.info(f"Server can't resume {url} at byte {offset}, downloading anew.")
+        return open_url(url)
+    # Check status *before* reading - urlopen might raise HTTPError for >=400 already
+    # but this is an extra check.
+    if response.status >= 400:
+        msg = f"HTTP Error {response.status} {response.reason} for URL {url}"
+        log.error(msg)
+        response.close()
+        # Re-raise as HTTPError for consistency if urlopen didn't already
+        raise urllib.error.HTTPError(
+            url, response.status, response.reason, response.headers, None
+        )
+
+    content_length_str = response.getheader("Content-Length")
+    total_size = 0
+    if content_length_str:
+        with contextlib.suppress(ValueError, TypeError):
+            total_size = int(content_length_str)
+    return response, total_size
+
+
+def download_file(
+    url: str,
+    destination: Path,
+    checksum: str | None = None,
+    *,
+    verify_existing: bool = True,
+) -> int:
     """
     Downloads a file from a URL to a destination path using urllib,
     optionally verifying its SHA256 checksum.
 
+    The checksum of a new download is calculated while writing it. An already
+    existing file is re-read for verification unless verify_existing is False,
+    in which case the caller is responsible for checking it against checksum.
+
+    destination may live in a cache shared by concurrent processes: they are
+    serialized by a lock file next to it, and a download only appears at
+    destination once it is complete (and verified).
+
+    Returns:
+        The size of the file at destination in bytes.
     Raises:
         ValueError: If checksum verification fails.
         urllib.error.URLError: For network errors during download.
@@ -66,13 +183,31 @@ def download_file(url: str, destination: Path, checksum: str | None = None) -> N
         OSError: For file system errors during write.
         RuntimeError: For other unexpected errors or read errors during verification.
     """
-    if destination.exists():
+    with download_lock(destination):
+        return _download_file_locked(url, destination, checksum, verify_existing)
+
+
+def _download_file_locked(
+    url: str, destination: Path, checksum: str | None, verify_existing: bool
+) -> int:
+    """download_file without the locking, see there."""
+    try:
+        existing_size: int | None = destination.stat().st_size
+    except FileNotFoundError:
+        existing_size = None
+
+    if existing_size is not None:
         log.info(f"File {destination} already exists.")
+        if checksum and not verify_existing:
+            log.info(
+                "Leaving checksum verification of the existing file to the caller."
+            )
+            return existing_size
         if checksum:
             try:
                 _verify_checksum(destination, checksum)
                 log.info("Existing file checksum matches. Skipping download.")
-                return  # Success, file exists and is valid
+                return existing_size  # Success, file exists and is valid
             except (ValueError, RuntimeError, FileNotFoundError) as e:
                 log.warning(
                     f"Existing file {destination} failed verification ({e}). Re-downloading..."
@@ -81,58 +216,72 @@ def download_file(url: str, destination: Path, checksum: str | None = None) -> N
                     destination.unlink()  # Remove corrupted/wrong file
         else:
             log.info("No checksum provided, using existing file.")
-            return  # Success, file exists
+            return existing_size  # Success, file exists
 
     log.info(f"Downloading {url} to {destination}...")
+    # Written next to destination and renamed into place once complete. What an
+    # interrupted download left there is resumed rather than fetched again.
+    partial = partial_path(destination)
     try:
-        # Ensure parent directory exists
-        destination.parent.mkdir(parents=True, exist_ok=True)
-
-        req = urllib.request.Request(
-            url, headers={"User-Agent": "vm-spawner/1.0"}
-        )  # More specific agent
-        with (
-            urllib.request.urlopen(req, timeout=300) as response,
-            destination.open("wb") as f,
-        ):
-            # Check status *before* reading - urlopen might raise HTTPError for >=400 already
-            # but this is an extra check.
-            if response.status >= 400:
-                msg = f"HTTP Error {response.status} {response.reason} for URL {url}"
-                log.error(msg)
-                # Re-raise as HTTPError for consistency if urlopen didn't already
-                raise urllib.error.HTTPError(
-                    url, response.status, response.reason, response.headers, None
-                )
-
-            content_length_str = response.getheader("Content-Length")
-            total_size = 0
-            if content_length_str:
-                with contextlib.suppress(ValueError, TypeError):
-                    total_size = int(content_length_str)
+        resume_from = partial.stat().st_size
+    except FileNotFoundError:
+        resume_from = 0
+    try:
+        response, total_size = open_url(url, resume_from)
+        if resume_from and response.status == 206:  # Partial Content
+            log.info(f"Resuming download after {resume_from} bytes.")
+            with partial.open("rb") as f:
+                hasher = sha256_file(f)  # The new bytes continue this digest
+            if total_size > 0:
+                total_size += resume_from
+            mode = "ab"
+        else:
+            resume_from = 0
+            hasher = hashlib.sha256()
+            mode = "wb"
+        downloaded_size = resume_from
+        with response, partial.open(mode) as f:
             if total_size <= 0:
                 log.warning("Could not determine Content-Length or it was zero.")
 
-            downloaded_size = 0
-            start_time = time.time()
-            chunk_size = 1024 * 1024  # 1MB chunk
-
+            # Progress is informational output, skip all of its math when INFO is off
+            show_progress = log.isEnabledFor(logging.INFO)
+            start_time = time.monotonic()
+            last_report = 0.0
             while True:
-                chunk = response.read(chunk_size)
+                try:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                except (OSError, http.client.HTTPException) as e:
+                    msg = f"connection lost after {downloaded_size} bytes: {e}"
+                    raise urllib.error.URLError(msg) from e
                 if not chunk:
+                    if 0 < total_size != downloaded_size:
+                        # http.client doesn't flag a connection closed early
+                        msg = f"connection closed after {downloaded_size} of {total_size} bytes"
+                        raise urllib.error.URLError(msg)
                     break
                 f.write(chunk)
+                hasher.update(chunk)
                 downloaded_size += len(chunk)
 
-                # Progress reporting (optional, can be removed if too verbose)
+                # Progress reporting (optional), at most every PROGRESS_INTERVAL seconds
+                if not show_progress:
+                    continue
+                now = time.monotonic()
+                if (
+                    now - last_report < PROGRESS_INTERVAL
+                    and downloaded_size != total_size
+                ):
+                    continue
+                last_report = now
                 percent_str = (
                     f" ({downloaded_size / total_size * 100:.1f}%)"
                     if total_size > 0
                     else ""
                 )
-                elapsed_time = time.time() - start_time
+                elapsed_time = now - start_time
                 speed = (
-                    (downloaded_size / elapsed_time / 1024 / 1024)
+                    ((downloaded_size - resume_from) / elapsed_time / 1024 / 1024)
                     if elapsed_time > 0
                     else 0.0
                 )
@@ -145,38 +294,38 @@ def download_file(url: str, destination: Path, checksum: str | None = None) -> N
                 )
             print("\nDownload complete.")  # Newline after progress
 
-    except (urllib.error.HTTPError, urllib.error.URLError) as e:
-        log.error(f"Network error downloading {url}: {e}", exc_info=True)
-        # Clean up potentially partial file
-        with contextlib.suppress(OSError):
-            if destination.exists():
-                destination.unlink()
+    except urllib.error.HTTPError as e:
+        log.error(f"HTTP error downloading {url}: {e}")
+        discard_partial(destination)
+        raise  # Re-raise the specific network error
+    except urllib.error.URLError as e:
+        log.error(f"Network error downloading {url}: {e}")
+        log.info(f"Keeping {partial} to resume the download from.")
         raise  # Re-raise the specific network error
     except OSError as e:
-        log.error(f"File system error writing to {destination}: {e}", exc_info=True)
-        # Clean up potentially partial file
-        with contextlib.suppress(OSError):
-            if destination.exists():
-                destination.unlink()
+        log.error(f"File system error writing to {partial}: {e}")
+        discard_partial(destination)
         raise  # Re-raise the file system error
     except Exception as e:
-        log.exception(f"An unexpected error occurred during download to {destination}")
-        # Clean up potentially partial file
-        with contextlib.suppress(OSError):
-            if destination.exists():
-                destination.unlink()
+        log.exception(f"An unexpected error occurred during download to {partial}")
+        discard_partial(destination)
         msg = f"Unexpected download error for {url}"
         raise RuntimeError(msg) from e
 
-    # Verify checksum *after* successful download if provided
+    # Verify checksum *after* successful download if provided, the digest was
+    # calculated on the fly so the file doesn't have to be read back
     if checksum:
         try:
-            _verify_checksum(destination, checksum)
-        except (ValueError, RuntimeError, FileNotFoundError):
+            check_checksum(partial, hasher.hexdigest(), checksum)
+        except ValueError:
             log.error(
                 f"Checksum verification failed after download for {destination}. Deleting file.",
                 exc_info=False,
             )
-            with contextlib.suppress(OSError):
-                destination.unlink()
+            discard_partial(destination)
             raise  # Re-raise the verification error
+
+    partial.replace(destination)
+
+    # Every byte went through our own write loop, no need to stat the file
+    return downloaded_size
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
-# ruff: noqa: TRY301 TRY300
+# ruff: noqa: TRY300
 
+import contextlib
+import functools
 import logging
 import shlex  # For safer command printing if needed later
-import subprocess
 import sys
 from pathlib import Path
+from string import Template
+from tempfile import TemporaryDirectory
 
-# from .create import
+from .create import (
+    disk_driver_attrs,
+    disk_driver_xml,
+    forget_cached_lookups,
+    get_group_id,
+    lookup_volume,
+    render_xml,
+    upload_volume_from_file,
+)
 from .remote import RemoteCommandError, run_remote_command
+from .seed import build_seed_iso, seed_volume_name
 
 # Assume libvirt is available
 try:
@@ -21,13 +33,216 @@ except ImportError:
     )
     sys.exit(1)
 
-from .upload import upload  # Assuming upload raises exceptions on failure
+log = logging.getLogger(__name__)
+
+# What virt-install produces for the options install_domain_with_virt_install
+# passes it, with the cloud-init seed image attached as a CD-ROM
+_DOMAIN_XML_TMPL = Template("""
+<domain type='kvm'>
+  <name>$name</name>
+  <memory unit='MiB'>$memory_mb</memory>
+  <vcpu>$vcpu</vcpu>
+  <os>
+    <type machine='q35'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+  </features>
+  <cpu mode='host-passthrough'/>
+  <clock offset='utc'/>
+  <devices>
+    <disk type='volume' device='disk'>
+      $disk_driver
+      <source pool='$pool_name' volume='$disk_volume_name'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <disk type='volume' device='cdrom'>
+      <driver name='qemu' type='raw'/>
+      <source pool='$pool_name' volume='$seed_volume_name'/>
+      <target dev='sda' bus='sata'/>
+      <readonly/>
+    </disk>
+    $interfaces
+    <serial type='pty'>
+      <target type='isa-serial' port='0'/>
+    </serial>
+    <console type='pty'>
+      <target type='serial' port='0'/>
+    </console>
+    <video>
+      <model type='qxl'/>
+    </video>
+    <rng model='virtio'>
+      <backend model='random'>/dev/urandom</backend>
+    </rng>
+  </devices>
+</domain>
+""")
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+_INTERFACE_XML_TMPL = Template("""\
+<interface type='network'>
+      <source network='$network'/>
+      <model type='virtio'/>
+    </interface>""")
+
+
+# Prints the path of virt-install on the remote host, building virt-manager
+# with nix there if it is not installed
+_FIND_VIRT_INSTALL = (
+    "command -v virt-install || "
+    "{ out=$(nix build --no-link --print-out-paths nixpkgs#virt-manager) && "
+    'echo "${out%%[[:space:]]*}/bin/virt-install"; }'
 )
-log = logging.getLogger(__name__)
+
+
+@functools.cache
+def remote_virt_install(host: str, ssh_key: Path | None) -> list[str]:
+    """
+    Returns the command that starts virt-install on the remote host. Its
+    path is resolved once per (host, ssh_key), so repeated installs don't
+    go through a nix evaluation each time. If resolving fails, the command
+    falls back to running virt-install through `nix shell`.
+
+    Raises:
+        RemoteCommandError: If the lookup times out or ssh fails.
+    """
+    result = run_remote_command(
+        host,
+        [shlex.join(["sh", "-c", _FIND_VIRT_INSTALL])],
+        timeout=600,  # Building virt-manager may take a while
+        check=False,
+        ssh_key=ssh_key,
+    )
+    path = result.stdout.splitlines()[-1] if result.stdout else ""
+    if result.returncode != 0 or not path.startswith("/"):
+        log.warning(f"Could not locate virt-install on {host}, using nix shell.")
+        return ["nix", "shell", "nixpkgs#virt-manager", "--command", "virt-install"]
+    log.info(f"Using {path} on {host}")
+    return [path]
+
+
+def _domain_exists(conn: libvirt.virConnect, name: str) -> bool:
+    """Best effort check whether domain name is already defined."""
+    try:
+        domain = conn.lookupByName(name)
+        state, _ = domain.state()
+        state_str = (
+            "running"
+            if state == libvirt.VIR_DOMAIN_RUNNING
+            else "defined but not running"
+        )
+        log.info(f"Domain '{name}' already exists ({state_str}). Skipping install.")
+        return True
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            log.info(f"Domain '{name}' not found. Proceeding with install...")
+        else:
+            # Log other libvirt errors during lookup but proceed with install attempt
+            log.warning(
+                f"Error looking up domain '{name}' (will attempt install anyway): {e}"
+            )
+            # Do not raise here, allow install attempt
+        return False
+
+
+def install_domain_direct(
+    conn: libvirt.virConnect,
+    name: str,
+    memory_mb: int,
+    vcpu: int,
+    disk_volume_name: str,
+    pool: libvirt.virStoragePool,
+    primary_network: str,
+    isolated_network: str | None,
+    user_data_path: Path,
+    network_config_path: Path,
+    remote_user_host: str,
+    ssh_key: Path | None,
+) -> None:
+    """
+    Creates and starts a domain from rendered XML over the libvirt connection,
+    equivalent to install_domain_with_virt_install without its options. This
+    skips starting virt-install (through nix) on the remote host, which
+    dominates the install time.
+
+    The cloud-init seed image is built locally and uploaded into the pool as
+    volume '<name>-cidata.iso', attached to the domain as a CD-ROM.
+
+    Raises:
+        RuntimeError: If the seed image cannot be built or uploaded, or the
+                      domain cannot be defined or started (also if no ISO
+                      builder is available locally, see seed_iso_tool).
+    """
+    if _domain_exists(conn, name):
+        return  # Domain exists, nothing more to do
+
+    # 1. Build the seed image and upload it into the pool
+    seed_name = seed_volume_name(name)
+    try:
+        stale_vol = lookup_volume(pool, seed_name)
+        if stale_vol is not None:
+            # Left behind by an earlier failed install under the same name
+            log.info(f"Deleting stale seed volume '{seed_name}'...")
+            stale_vol.delete(0)
+            forget_cached_lookups()  # The volume listing still has it
+        with TemporaryDirectory(prefix="vm_spawner-") as tmp:
+            seed_iso = Path(tmp) / seed_name
+            build_seed_iso(name, user_data_path, network_config_path, seed_iso)
+            seed_vol = upload_volume_from_file(
+                conn,
+                pool,
+                seed_name,
+                seed_iso,
+                seed_iso.stat().st_size,
+                "raw",
+                get_group_id(remote_user_host, ssh_key),
+            )
+    except (libvirt.libvirtError, OSError, RemoteCommandError) as e:
+        log.error(f"Failed to provide cloud-init seed for domain '{name}': {e}")
+        msg = f"Failed to provide cloud-init seed for domain '{name}'"
+        raise RuntimeError(msg) from e
+
+    # 2. Define and start the domain
+    interfaces = [primary_network]
+    if isolated_network:
+        interfaces.append(isolated_network)
+    domain_xml = render_xml(
+        _DOMAIN_XML_TMPL,
+        fragments={
+            # Disk driver with the fastest I/O mode the host supports
+            "disk_driver": disk_driver_xml(conn),
+            "interfaces": "\n    ".join(
+                render_xml(_INTERFACE_XML_TMPL, network=network)
+                for network in interfaces
+            ),
+        },
+        name=name,
+        memory_mb=memory_mb,
+        vcpu=vcpu,
+        pool_name=pool.name(),
+        disk_volume_name=disk_volume_name,
+        seed_volume_name=seed_name,
+    )
+    log.info(f"Defining domain '{name}'...")
+    log.debug(f"Domain '{name}' XML:\n{domain_xml}")
+    domain: libvirt.virDomain | None = None
+    try:
+        # Persistent like a virt-install'ed domain, so it can be undefined later
+        domain = conn.defineXML(domain_xml)
+        domain.create()
+        log.info(f"Domain '{name}' installed successfully.")
+    except libvirt.libvirtError as e:
+        log.error(f"Failed to define or start domain '{name}': {e}")
+        with contextlib.suppress(libvirt.libvirtError):
+            if domain:
+                domain.undefine()
+        with contextlib.suppress(libvirt.libvirtError):
+            seed_vol.delete(0)
+        forget_cached_lookups()
+        msg = f"Failed to install domain '{name}'"
+        raise RuntimeError(msg) from e
 
 
 def install_domain_with_virt_install(
@@ -43,7 +258,7 @@ def install_domain_with_virt_install(
     user_data_path: Path,
     network_config_path: Path,
     remote_user_host: str,
-    remote_tmp_dir: Path,
+    remote_tmp_dir: Path | None,
     ssh_key: Path | None,
     libvirt_system_uri: str = "qemu:///system",
     extra_virt_install_args: list[str] | None = None,
@@ -51,6 +266,10 @@ def install_domain_with_virt_install(
     """
     Creates a domain using the virt-install command via SSH with cloud-init.
 
+    The cloud-init files are staged in remote_tmp_dir. If it is None, a scratch
+    dir named after the domain is created by the upload and removed by the
+    virt-install session, saving the round trips of managing it separately.
+
     Raises:
         RuntimeError: If virt-install fails, times out, or cloud-init files cannot be uploaded.
         RemoteCommandError: If SSH command execution fails.
@@ -59,65 +278,50 @@ def install_domain_with_virt_install(
         libvirt.libvirtError: If checking domain existence fails (unexpectedly).
     """
     # 1. Check if domain already exists (best effort)
-    try:
-        domain = conn.lookupByName(name)
-        state, _ = domain.state()
-        state_str = (
-            "running"
-            if state == libvirt.VIR_DOMAIN_RUNNING
-            else "defined but not running"
-        )
-        log.info(
-            f"Domain '{name}' already exists ({state_str}). Skipping virt-install."
-        )
+    if _domain_exists(conn, name):
         return  # Domain exists, nothing more to do
-    except libvirt.libvirtError as e:
-        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-            log.info(f"Domain '{name}' not found. Proceeding with virt-install...")
-        else:
-            # Log other libvirt errors during lookup but proceed with install attempt
-            log.warning(
-                f"Error looking up domain '{name}' (will attempt install anyway): {e}"
-            )
-            # Do not raise here, allow install attempt
 
     # 2. Define remote paths for cloud-init files
+    own_tmp_dir = remote_tmp_dir is None
+    if remote_tmp_dir is None:
+        remote_tmp_dir = Path(f"/tmp/vm_spawner.{name}")
     remote_user_data_path = remote_tmp_dir / f"{name}-user-data.cfg"
     remote_network_config_path = remote_tmp_dir / f"{name}-network-config.cfg"
 
-    # 3. Upload cloud-init files (assuming vm_spawner.upload raises on error)
+    # 3. Upload cloud-init files, both in one ssh session (raises on error)
+    # Imported here, tarfile and its compressors are only needed on this path
+    from .upload import upload_files
+
     try:
         log.info(
-            f"Uploading {user_data_path} to {remote_user_host}:{remote_user_data_path}..."
-        )
-        upload(remote_user_host, user_data_path, remote_user_data_path, ssh_key=ssh_key)
-        log.info(
-            f"Uploading {network_config_path} to {remote_user_host}:{remote_network_config_path}..."
+            f"Uploading {user_data_path} and {network_config_path} to {remote_user_host}:{remote_tmp_dir}..."
         )
-        upload(
+        upload_files(
             remote_user_host,
-            network_config_path,
-            remote_network_config_path,
+            {
+                user_data_path: remote_user_data_path.name,
+                network_config_path: remote_network_config_path.name,
+            },
+            remote_tmp_dir,
             ssh_key=ssh_key,
+            create_remote_dir=own_tmp_dir,
         )
     except Exception as upload_e:  # Catch specific upload errors if possible
         log.error(f"Failed to upload cloud-init files: {upload_e}", exc_info=True)
         msg = "Failed to upload cloud-init files"
         raise RuntimeError(msg) from upload_e
 
-    shell_cmd = []
-    # Check if virt-install should be run inside nix-shell
-    use_nix_shell = True  # Or make this configurable if needed
-    if use_nix_shell:
-        shell_cmd.extend(["nix", "shell", "nixpkgs#virt-manager", "--command"])
-
+    disk_driver_opts = ",".join(
+        f"driver.{key}={value}" for key, value in disk_driver_attrs(conn).items()
+    )
     virt_install_cmd = [
-        "virt-install",
+        *remote_virt_install(remote_user_host, ssh_key),
         f"--connect={libvirt_system_uri}",
         f"--name={name}",
         f"--memory={memory_mb}",
         f"--vcpus={vcpu}",
-        f"--disk=vol={pool_name}/{base_volume_name},device=disk,bus=virtio",  # Reference the volume
+        # Reference the volume, with the fastest I/O mode the host supports
+        f"--disk=vol={pool_name}/{base_volume_name},device=disk,bus=virtio,{disk_driver_opts}",
         f"--network=network={primary_network},model=virtio",
     ]
     if isolated_network:
@@ -142,22 +346,29 @@ def install_domain_with_virt_install(
     if extra_virt_install_args:
         virt_install_cmd.extend(extra_virt_install_args)
 
-    full_cmd = shell_cmd + virt_install_cmd
-    log.info(
-        "Executing virt-install command via SSH:\n%s",
-        " ".join(map(shlex.quote, full_cmd)),
-    )
+    full_cmd = shlex.join(virt_install_cmd)
+    log.info("Executing virt-install command via SSH:\n%s", full_cmd)
+    # virt-install has packed the cloud-init files into the domain's seed ISO by
+    # the time it returns, remove them in the same session, keeping its status
+    if own_tmp_dir:
+        cleanup_cmd = shlex.join(["rm", "-rf", str(remote_tmp_dir)])
+    else:
+        cleanup_cmd = shlex.join(
+            ["rm", "-f", str(remote_user_data_path), str(remote_network_config_path)]
+        )
+    install_script = f"{full_cmd}; rc=$?; {cleanup_cmd}; exit $rc"
 
     # 5. Execute virt-install via SSH and clean up remote files
     timeout_seconds = 600  # 10 minutes
     try:
         # Use run_remote_command which wraps subprocess and raises specific errors
-        # Note: run_remote_command needs the command parts *after* the host argument
         run_remote_command(
-            host=remote_user_host,  # This is slightly redundant with ssh_prefix, refactor if needed
-            command=full_cmd,  # Pass only the command part
+            host=remote_user_host,
+            command=[shlex.join(["sh", "-c", install_script])],
             timeout=timeout_seconds,
             ssh_key=ssh_key,
+            # Show virt-install's progress as it happens, not after minutes
+            stream_output=True,
         )
         # run_remote_command already logs stdout/stderr, just log success here
         log.info(f"Domain '{name}' installed successfully via virt-install.")
@@ -185,34 +396,3 @@ def install_domain_with_virt_install(
         )
         msg = f"Unexpected error during virt-install for {name}"
         raise RuntimeError(msg) from e
-    finally:
-        # Best effort cleanup of remote cloud-init files
-        log.info("Attempting cleanup of remote cloud-init files...")
-        cleanup_cmd_parts = [
-            "rm",
-            "-f",
-            str(remote_user_data_path),
-            str(remote_network_config_path),
-        ]
-        try:
-            # Run cleanup command directly, ignore failures (check=False)
-            ssh_cleanup_cmd = [
-                "ssh",
-                "-o",
-                "StrictHostKeyChecking=no",
-                "-o",
-                "UserKnownHostsFile=/dev/null",
-                remote_user_host,
-                "--",
-                *cleanup_cmd_parts,
-            ]
-            subprocess.run(
-                ssh_cleanup_cmd, capture_output=True, text=True, check=False, timeout=30
-            )
-            log.info("Remote cloud-init file cleanup command executed.")
-        except Exception as cleanup_e:
-            # Log cleanup errors but don't let them mask the primary exception (if any)
-            log.warning(
-                f"Failed to cleanup remote cloud-init files: {cleanup_e}",
-                exc_info=False,
-            )
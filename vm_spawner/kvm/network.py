@@ -1,43 +1,36 @@
 #!/usr/bin/env python3
 import contextlib
+import random
 import sys
+import threading
 import time
+import weakref
 import xml.etree.ElementTree as ET
 
 import libvirt
 
+# First wait between two DHCP lease checks, doubled after every miss
+LEASE_POLL_MIN_DELAY = 0.1
+# Up to this fraction is added to each wait at random, so that parallel
+# deploys don't all poll libvirtd at the same instants
+LEASE_POLL_JITTER = 0.1
 
-def get_domain_ip_from_network(
-    conn: libvirt.virConnect,
-    domain_name: str,
-    network_name: str,
-    retries: int = 60,
-    delay: float = 1.0,
-    verbose: bool = False,
-) -> str | None:
-    """
-    Retrieves the DHCP-assigned IP address for a given domain connected to a specific network.
+# (domain, network, MACs) per (domain name, network name) remembered per
+# connection, so that polling get_domain_ip_from_network from outside doesn't
+# repeat the lookups and the XML parsing
+RESOLVED_CACHE_SIZE = 64
+_resolved: "weakref.WeakKeyDictionary[libvirt.virConnect, dict[tuple[str, str], tuple[libvirt.virDomain, libvirt.virNetwork, frozenset[str]]]]" = weakref.WeakKeyDictionary()
+_resolved_lock = threading.Lock()
 
-    Args:
-        conn: An active libvirt connection object.
-        domain_name: The name of the virtual machine (domain).
-        network_name: The name of the libvirt network.
-        retries: Number of times to check for the DHCP lease.
-        delay: Seconds to wait between retries.
-        verbose: If True, print verbose P R O C E S S I N G: messages during retries.
 
-    Returns:
-        The IPv4 address string if found, otherwise None.
-        Returns None immediately if the domain or network doesn't exist or the domain is not running.
+def _resolve(
+    conn: libvirt.virConnect, domain_name: str, network_name: str, verbose: bool
+) -> tuple[libvirt.virDomain, libvirt.virNetwork, frozenset[str]] | None:
+    """
+    Looks up the domain and the network and returns them with the MAC addresses
+    of the domain's interfaces on that network, None (after printing why) if
+    there is nothing to wait for.
     """
-    if verbose:
-        print(
-            f"Attempting to find IP for domain '{domain_name}' on network '{network_name}'..."
-        )
-
-    domain: libvirt.virDomain | None = None
-    network: libvirt.virNetwork | None = None
-
     try:
         domain = conn.lookupByName(domain_name)
     except libvirt.libvirtError as e:
@@ -56,15 +49,7 @@ def get_domain_ip_from_network(
         print(f"Error looking up network '{network_name}': {e}", file=sys.stderr)
         return None
 
-    if not domain.isActive():
-        print(f"Info: Domain '{domain_name}' is not running.", file=sys.stderr)
-        return None
-
-    if not network.isActive():
-        print(f"Info: Network '{network_name}' is not active.", file=sys.stderr)
-        return None
-
-    target_macs = []
+    target_macs: set[str] = set()
     try:
         # Parse the domain's XML to find interfaces connected to the target network
         xml_desc = domain.XMLDesc(0)
@@ -76,7 +61,7 @@ def get_domain_ip_from_network(
                 source_network = source.get("network")
                 mac_address = mac.get("address")
                 if source_network == network_name and mac_address:
-                    target_macs.append(mac_address.lower())  # Store MACs in lower case
+                    target_macs.add(mac_address.lower())  # Store MACs in lower case
 
         if not target_macs:
             print(
@@ -86,7 +71,7 @@ def get_domain_ip_from_network(
             return None
         if verbose:
             print(
-                f"Found MAC addresses for '{domain_name}' on '{network_name}': {target_macs}"
+                f"Found MAC addresses for '{domain_name}' on '{network_name}': {sorted(target_macs)}"
             )
 
     except ET.ParseError as e:
@@ -99,77 +84,290 @@ def get_domain_ip_from_network(
         )
         return None
 
-    for attempt in range(retries):
-        if verbose:
-            print(
-                f"Attempt {attempt + 1}/{retries}: Querying DHCP leases on '{network_name}'..."
-            )
-        try:
-            # Get DHCP leases for the network
-            # Note: Returns leases for *all* VMs on the network
-            leases = network.DHCPLeases()  # Timeout parameter is optional
-            if not leases:
-                if verbose:
-                    print("No active DHCP leases found on the network yet.")
+    return domain, network, frozenset(target_macs)
 
-            for lease in leases:
-                # Example lease format:
-                # {'expirytime': 1678886400, 'mac': '52:54:00:xx:yy:zz', 'ipaddr': '192.168.122.100',
-                #  'prefix': 24, 'hostname': 'vm-name', 'clientid': '...', 'iaid': '...'}
-                # 'type': libvirt.VIR_IP_ADDR_TYPE_IPV4 (or IPV6)
 
-                lease_mac = lease.get("mac", "").lower()
-                ip_addr = lease.get("ipaddr")
-                ip_type = lease.get("type")  # Check if it's an IPv4 address
-
-                if (
-                    ip_addr
-                    and lease_mac in target_macs
-                    and ip_type == libvirt.VIR_IP_ADDR_TYPE_IPV4
-                ):
-                    if verbose:
-                        print(f"Found matching lease: MAC={lease_mac}, IP={ip_addr}")
-                    print(
-                        f"Success: IP address for '{domain_name}' on network '{network_name}' is {ip_addr}"
-                    )
-                    return ip_addr  # Found the IP for our VM's MAC
-
-        except libvirt.libvirtError as e:
+def _cached_resolve(
+    conn: libvirt.virConnect, domain_name: str, network_name: str, verbose: bool
+) -> tuple[libvirt.virDomain, libvirt.virNetwork, frozenset[str]] | None:
+    """_resolve, remembered per connection for callers polling for the IP."""
+    key = (domain_name, network_name)
+    with _resolved_lock:
+        resolved = _resolved.get(conn, {}).get(key)
+    if resolved is not None:
+        return resolved
+    resolved = _resolve(conn, domain_name, network_name, verbose)
+    if resolved is not None:
+        with _resolved_lock:
+            per_conn = _resolved.setdefault(conn, {})
+            per_conn[key] = resolved
+            while len(per_conn) > RESOLVED_CACHE_SIZE:
+                del per_conn[next(iter(per_conn))]  # Oldest first
+    return resolved
+
+
+def _forget_resolved(
+    conn: libvirt.virConnect, domain_name: str, network_name: str
+) -> None:
+    with _resolved_lock:
+        _resolved.get(conn, {}).pop((domain_name, network_name), None)
+
+
+def get_domain_ip_from_network(
+    conn: libvirt.virConnect,
+    domain_name: str,
+    network_name: str,
+    retries: int = 60,
+    delay: float = 1.0,
+    verbose: bool = False,
+) -> str | None:
+    """
+    Retrieves the DHCP-assigned IP address for a given domain connected to a specific network.
+
+    Args:
+        conn: An active libvirt connection object.
+        domain_name: The name of the virtual machine (domain).
+        network_name: The name of the libvirt network.
+        retries: Together with delay, bounds the wait to retries * delay seconds.
+        delay: Longest wait between two checks. Checks start 0.1s apart and back
+               off exponentially (with some jitter) up to delay, so an early
+               lease is seen quickly.
+        verbose: If True, print verbose P R O C E S S I N G: messages during retries.
+
+    Returns:
+        The IPv4 address string if found, otherwise None.
+        The domain, the network and the domain's MACs on it are looked up once
+        per connection, calling this again (e.g. in a loop) only re-checks that
+        both are active.
+        Returns None immediately if the domain or network doesn't exist or the domain is not running.
+    """
+    if verbose:
+        print(
+            f"Attempting to find IP for domain '{domain_name}' on network '{network_name}'..."
+        )
+
+    resolved = _cached_resolve(conn, domain_name, network_name, verbose)
+    if resolved is None:
+        return None
+    domain, network, target_macs = resolved
+
+    try:
+        domain_active, network_active = domain.isActive(), network.isActive()
+    except libvirt.libvirtError as e:
+        if e.get_error_code() not in (
+            libvirt.VIR_ERR_NO_DOMAIN,
+            libvirt.VIR_ERR_NO_NETWORK,
+        ):
+            raise
+        # Undefined since they were remembered, maybe redefined under the same name
+        _forget_resolved(conn, domain_name, network_name)
+        resolved = _cached_resolve(conn, domain_name, network_name, verbose)
+        if resolved is None:
+            return None
+        domain, network, target_macs = resolved
+        domain_active, network_active = domain.isActive(), network.isActive()
+
+    if not domain_active:
+        print(f"Info: Domain '{domain_name}' is not running.", file=sys.stderr)
+        return None
+
+    if not network_active:
+        print(f"Info: Network '{network_name}' is not active.", file=sys.stderr)
+        return None
+
+    watcher = LeaseWatcher.get(conn, network_name, network)
+    return watcher.wait_for_macs(
+        domain_name, target_macs, timeout=retries * delay, delay=delay, verbose=verbose
+    )
+
+
+def _is_fatal_lease_error(e: Exception) -> bool:
+    """Whether the network fundamentally won't give leases, so retrying is pointless."""
+    return isinstance(e, libvirt.libvirtError) and (
+        "network is not active" in str(e).lower()
+        or "DHCP server is not running" in str(e).lower()
+    )
+
+
+class LeaseWatcher:
+    """
+    Polls the DHCP leases of one network for everyone waiting on an IP there.
+    Deploying N VMs in parallel then costs one DHCPLeases call per interval
+    instead of N. The polling thread runs only while someone is waiting.
+    """
+
+    _watchers: "weakref.WeakKeyDictionary[libvirt.virConnect, dict[str, LeaseWatcher]]" = weakref.WeakKeyDictionary()
+    _watchers_lock = threading.Lock()
+
+    @classmethod
+    def get(
+        cls, conn: libvirt.virConnect, network_name: str, network: libvirt.virNetwork
+    ) -> "LeaseWatcher":
+        """Returns the watcher of network on conn, created on first use."""
+        with cls._watchers_lock:
+            per_conn = cls._watchers.setdefault(conn, {})
+            watcher = per_conn.get(network_name)
+            if watcher is None:
+                watcher = per_conn[network_name] = cls(network_name, network)
+        with watcher._cond:
+            # Possibly looked up again since, e.g. after being redefined
+            watcher._network = network
+        return watcher
+
+    def __init__(self, network_name: str, network: libvirt.virNetwork) -> None:
+        self._network_name = network_name
+        self._network = network
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        # Longest wait between two polls and the MACs, per waiting call
+        self._waiters: dict[object, tuple[float, frozenset[str]]] = {}
+        self._new_waiter = False
+        # Outcome of the latest poll: IPv4 address per lower case MAC, or the error
+        self._polls = 0
+        self._ip_by_mac: dict[str, str] = {}
+        self._error: Exception | None = None
+
+    def wait_for_macs(
+        self,
+        domain_name: str,
+        macs: frozenset[str],
+        *,
+        timeout: float,
+        delay: float,
+        verbose: bool = False,
+    ) -> str | None:
+        """
+        Waits up to timeout seconds for a lease of one of macs (lower case).
+        Polls start 0.1s apart and back off exponentially (with some jitter)
+        up to the smallest delay of all waiters.
+
+        Returns:
+            The IPv4 address if a lease showed up, otherwise None.
+        """
+        token = object()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._waiters[token] = (delay, macs)
+            self._new_waiter = True  # Poll right away, with the backoff reset
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._poll_loop,
+                    name=f"dhcp-leases-{self._network_name}",
+                    daemon=True,
+                )
+                self._thread.start()
+            self._cond.notify_all()
+            # Only leases seen after being registered count, like a poll of our own
+            seen = self._polls
+            attempt = 0
+            try:
+                while True:
+                    if self._polls > seen:
+                        seen = self._polls
+                        attempt += 1
+                        ip_addr = self._check_poll(domain_name, macs, attempt, verbose)
+                        if ip_addr is not None:
+                            return ip_addr or None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            finally:
+                del self._waiters[token]
+                self._cond.notify_all()  # The poller may be done
+
+        print(
+            f"Error: Could not find DHCP lease for domain '{domain_name}' on network '{self._network_name}' after {attempt} attempts.",
+            file=sys.stderr,
+        )
+        return None
+
+    def _check_poll(
+        self, domain_name: str, macs: frozenset[str], attempt: int, verbose: bool
+    ) -> str | None:
+        """
+        Looks through the latest poll, with self._cond held. Returns the IP of
+        one of macs, "" if the poll failed fatally, otherwise None.
+        """
+        e = self._error
+        if isinstance(e, libvirt.libvirtError):
             # Handle cases where DHCP might not be enabled or network is down
             print(
-                f"Warning: libvirt error getting DHCP leases (attempt {attempt + 1}): {e}",
+                f"Warning: libvirt error getting DHCP leases (attempt {attempt}): {e}",
                 file=sys.stderr,
             )
-            # Decide if this error is fatal or worth retrying
-            if (
-                "network is not active" in str(e).lower()
-                or "DHCP server is not running" in str(e).lower()
-            ):
+            if _is_fatal_lease_error(e):
                 print(
                     "Error: Cannot get leases from inactive network or network without DHCP.",
                     file=sys.stderr,
                 )
-                return (
-                    None  # Don't retry if the network fundamentally won't give leases
-                )
-
-        except Exception as e:
+                return ""
+            return None
+        if e is not None:
             print(
-                f"Unexpected error getting DHCP leases (attempt {attempt + 1}): {e}",
+                f"Unexpected error getting DHCP leases (attempt {attempt}): {e}",
                 file=sys.stderr,
             )
             # Could be temporary, so continue retrying unless it's clearly fatal
+            return None
 
-        if attempt < retries - 1:
-            if verbose:
-                print(f"IP not found yet, waiting {delay} seconds...")
-            time.sleep(delay)
+        for mac in macs:
+            ip_addr = self._ip_by_mac.get(mac)
+            if ip_addr:
+                if verbose:
+                    print(f"Found matching lease: MAC={mac}, IP={ip_addr}")
+                print(
+                    f"Success: IP address for '{domain_name}' on network '{self._network_name}' is {ip_addr}"
+                )
+                return ip_addr  # Found the IP for our VM's MAC
+        if verbose:
+            print(
+                f"Attempt {attempt}: No DHCP lease found on '{self._network_name}' for the domain's MACs yet."
+            )
+        return None
 
-    print(
-        f"Error: Could not find DHCP lease for domain '{domain_name}' on network '{network_name}' after {retries} attempts.",
-        file=sys.stderr,
-    )
-    return None
+    def _poll_loop(self) -> None:
+        ipv4 = libvirt.VIR_IP_ADDR_TYPE_IPV4
+        backoff = LEASE_POLL_MIN_DELAY
+        while True:
+            with self._cond:
+                if not self._waiters:
+                    self._thread = None
+                    return
+                self._new_waiter = False
+                network = self._network
+                delay = min(d for d, _ in self._waiters.values())
+                macs = frozenset().union(*(m for _, m in self._waiters.values()))
+
+            try:
+                if len(macs) == 1:
+                    # libvirt filters by MAC, the other VMs' leases are not transferred
+                    leases = network.DHCPLeases(next(iter(macs)), 0)
+                else:
+                    leases = network.DHCPLeases()
+                # Example lease format:
+                # {'expirytime': 1678886400, 'mac': '52:54:00:xx:yy:zz', 'ipaddr': '192.168.122.100',
+                #  'prefix': 24, 'hostname': 'vm-name', 'clientid': '...', 'iaid': '...'}
+                # 'type': libvirt.VIR_IP_ADDR_TYPE_IPV4 (or IPV6)
+                ip_by_mac = {
+                    lease.get("mac", "").lower(): lease["ipaddr"]
+                    for lease in leases
+                    if lease.get("type") == ipv4 and lease.get("ipaddr")
+                }
+                error = None
+            except Exception as e:
+                ip_by_mac, error = {}, e
+
+            with self._cond:
+                self._polls += 1
+                self._ip_by_mac, self._error = ip_by_mac, error
+                self._cond.notify_all()
+                wait = min(backoff * (1 + random.uniform(0, LEASE_POLL_JITTER)), delay)
+                self._cond.wait_for(lambda: self._new_waiter or not self._waiters, wait)
+                if self._new_waiter:
+                    backoff = LEASE_POLL_MIN_DELAY
+                else:
+                    backoff *= 2
 
 
 # --- Example Usage ---
@@ -1,20 +1,35 @@
 #!/usr/bin/env python3
 
-# ruff: noqa: TRY301 TRY300
-
+import atexit
+import contextlib
+import hashlib
 import logging
+import os
+import re
 import shlex  # For safer command printing if needed later
 import subprocess
+import threading
 from dataclasses import dataclass
 from pathlib import Path
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
+from vm_spawner.dirs import user_cache_dir
+
 log = logging.getLogger(__name__)
 
 
+# Lines ssh prints to stderr on its own, e.g. on the first connection to a host
+_SSH_NOISE = re.compile(
+    r"Pseudo-terminal will not be allocated|Warning: Permanently added"
+)
+
+
+def _filter_ssh_noise(stderr: str) -> str:
+    """Returns stderr without the lines matching _SSH_NOISE."""
+    return "\n".join(
+        line for line in stderr.splitlines() if not _SSH_NOISE.search(line)
+    )
+
+
 class RemoteCommandError(RuntimeError):
     """Custom exception for remote command failures."""
 
@@ -33,25 +48,93 @@ class RemoteCommandError(RuntimeError):
         self.stderr = stderr
 
     def __str__(self) -> str:
-        details = f"Command: {' '.join(map(shlex.quote, self.command))}"
+        details = f"Command: {shlex.join(self.command)}"
         if self.returncode is not None:
             details += f"\nReturn Code: {self.returncode}"
         if self.stdout:
             details += f"\nStdout:\n{self.stdout}"
         if self.stderr:
-            # Filter common SSH noise
-            filtered_stderr = "\n".join(
-                line
-                for line in self.stderr.splitlines()
-                if "Pseudo-terminal will not be allocated" not in line
-                and "Warning: Permanently added"
-                not in line  # Filter common first connection noise
-            )
+            filtered_stderr = _filter_ssh_noise(self.stderr)
             if filtered_stderr.strip():
                 details += f"\nStderr:\n{filtered_stderr}"
         return f"{super().__str__()}\n{details}"
 
 
+# Idle time after which a shared SSH master connection shuts itself down
+SSH_CONTROL_PERSIST = "10m"
+
+_control_paths: dict[tuple[str, Path | None], Path] = {}
+_control_paths_lock = threading.Lock()
+
+
+def ssh_multiplex_options(host: str, ssh_key: Path | None) -> list[str]:
+    """
+    Returns ssh options that share one ControlMaster connection per (host, ssh_key)
+    within this process.
+
+    The first ssh started with these options becomes the master, later ones
+    reuse its TCP connection and authentication instead of doing a full
+    handshake. The masters are this process's own (its pid is part of the
+    socket name) and are closed when it exits, so concurrent vm_spawner runs
+    never close a master another one's sessions are using.
+    """
+    key = (host, ssh_key)
+    with _control_paths_lock:
+        control_path = _control_paths.get(key)
+        if control_path is None:
+            control_dir = user_cache_dir() / "vm_spawner" / "ssh"
+            control_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # Hash to stay below the unix socket path length limit
+            digest = hashlib.sha256(f"{host}\0{ssh_key}".encode()).hexdigest()[:16]
+            control_path = control_dir / f"cm-{os.getpid()}-{digest}.sock"
+            _control_paths[key] = control_path
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={control_path}",
+        "-o",
+        f"ControlPersist={SSH_CONTROL_PERSIST}",
+    ]
+
+
+@atexit.register
+def _close_ssh_masters() -> None:
+    with _control_paths_lock:
+        for (host, _), control_path in _control_paths.items():
+            if not control_path.exists():
+                continue
+            with contextlib.suppress(subprocess.SubprocessError, OSError):
+                subprocess.run(
+                    ["ssh", "-o", f"ControlPath={control_path}", "-O", "exit", host],
+                    capture_output=True,
+                    check=False,
+                    timeout=10,
+                )
+        _control_paths.clear()
+
+
+def ssh_base_command(host: str, ssh_key: Path | None) -> list[str]:
+    """
+    Returns the ssh invocation, up to but excluding the destination, that every
+    connection to host uses, so they all share one ControlMaster.
+    """
+    ssh_cmd = [
+        "ssh",
+        "-o",
+        "StrictHostKeyChecking=no",
+        "-o",
+        "UserKnownHostsFile=/dev/null",
+        *ssh_multiplex_options(host, ssh_key),
+    ]
+    if ssh_key:
+        ssh_cmd += [
+            "-i",
+            str(ssh_key),  # Use the provided SSH key
+        ]
+    return ssh_cmd
+
+
 @dataclass
 class RemoteCommandResult:
     """Class to hold the result of a remote command execution."""
@@ -61,6 +144,58 @@ class RemoteCommandResult:
     returncode: int
 
 
+def _run_streaming(
+    cmd: list[str], *, timeout: int, check: bool
+) -> subprocess.CompletedProcess[str]:
+    """
+    subprocess.run(cmd, capture_output=True, ...) as in run_remote_command that
+    also logs each line of output as soon as it arrives, for commands running
+    for minutes.
+    """
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=1,
+        encoding="utf-8",
+        errors="replace",
+    ) as proc:
+        assert proc.stdout is not None
+        assert proc.stderr is not None
+        stderr_lines: list[str] = []
+
+        def drain_stderr() -> None:
+            assert proc.stderr is not None
+            for line in proc.stderr:
+                stderr_lines.append(line)
+                # Filter common SSH noise before logging
+                if not _SSH_NOISE.search(line):
+                    log.warning("[remote stderr] %s", line.rstrip("\n"))
+
+        stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+        stderr_thread.start()
+        # Reading blocks until the next line, a timer enforces the deadline
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            stdout_lines: list[str] = []
+            for line in proc.stdout:
+                stdout_lines.append(line)
+                log.info("[remote] %s", line.rstrip("\n"))
+            returncode = proc.wait()
+            stderr_thread.join()
+        finally:
+            timed_out = not timer.is_alive()
+            timer.cancel()
+
+    stdout, stderr = "".join(stdout_lines), "".join(stderr_lines)
+    if timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout, stdout, stderr)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+
 def run_remote_command(
     host: str,
     command: list[str],
@@ -68,9 +203,12 @@ def run_remote_command(
     timeout: int = 60,
     check: bool = True,
     ssh_key: Path | None = None,
+    stream_output: bool = False,
 ) -> RemoteCommandResult:
     """
     Runs a command on the remote host via SSH.
+    With stream_output, its output is logged line by line while it runs
+    instead of all at once when it has finished.
 
     Returns:
         The stdout of the command, stripped of leading/trailing whitespace.
@@ -80,39 +218,32 @@ def run_remote_command(
         FileNotFoundError: If the 'ssh' command is not found locally.
     """
     ssh_cmd = [
-        "ssh",
-        "-o",
-        "StrictHostKeyChecking=no",
-        "-o",
-        "UserKnownHostsFile=/dev/null",
-    ]
-
-    if ssh_key:
-        ssh_cmd += [
-            "-i",
-            str(ssh_key),  # Use the provided SSH key
-        ]
-
-    ssh_cmd += [
+        *ssh_base_command(host, ssh_key),
         "-T",  # Disable pseudo-terminal allocation
         host,
         "--",
         *command,
     ]
-    log.info(f"Executing remote command via SSH: {' '.join(map(shlex.quote, ssh_cmd))}")
+    if log.isEnabledFor(logging.INFO):
+        log.info(f"Executing remote command via SSH: {shlex.join(ssh_cmd)}")
     try:
-        result = subprocess.run(
-            ssh_cmd, check=check, capture_output=True, text=True, timeout=timeout
-        )
-        log.info("Remote command stdout:\n%s", result.stdout)
-        if result.stderr:
-            # Filter common SSH noise before logging
-            filtered_stderr = "\n".join(
-                line
-                for line in result.stderr.splitlines()
-                if "Pseudo-terminal will not be allocated" not in line
-                and "Warning: Permanently added" not in line
+        if stream_output:
+            result = _run_streaming(ssh_cmd, timeout=timeout, check=check)
+        else:
+            result = subprocess.run(
+                ssh_cmd,
+                check=check,
+                capture_output=True,
+                timeout=timeout,
+                # Whatever the local locale, and bytes that aren't UTF-8
+                # shouldn't fail a command after it ran
+                encoding="utf-8",
+                errors="replace",
             )
+            log.info("Remote command stdout:\n%s", result.stdout)
+        if result.stderr and not stream_output:
+            # Filter common SSH noise before logging
+            filtered_stderr = _filter_ssh_noise(result.stderr)
             if filtered_stderr.strip():
                 log.warning("Remote command stderr:\n%s", filtered_stderr)
         log.info("Remote command successful.")
@@ -0,0 +1,73 @@
+import functools
+import logging
+import shutil
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+log = logging.getLogger(__name__)
+
+# mkisofs comes with cdrtools (see default.nix), the others are compatible
+_ISO_TOOLS = ("mkisofs", "genisoimage", "xorrisofs")
+
+
+def seed_volume_name(domain_name: str) -> str:
+    """Name of the pool volume holding the cloud-init seed image of a domain."""
+    return f"{domain_name}-cidata.iso"
+
+
+@functools.cache
+def seed_iso_tool() -> str | None:
+    """Returns the local ISO 9660 image builder to use, None if there is none."""
+    for tool in _ISO_TOOLS:
+        path = shutil.which(tool)
+        if path is not None:
+            log.debug(f"Building cloud-init seed images with {path}")
+            return path
+    log.info(f"None of {', '.join(_ISO_TOOLS)} found locally.")
+    return None
+
+
+def build_seed_iso(
+    instance_id: str, user_data: Path, network_config: Path, destination: Path
+) -> None:
+    """
+    Writes a cloud-init NoCloud seed image ("cidata" volume) to destination.
+
+    Raises:
+        FileNotFoundError: If no ISO builder is available locally.
+        RuntimeError: If building the image fails.
+        OSError: If the input files cannot be read.
+    """
+    tool = seed_iso_tool()
+    if tool is None:
+        msg = f"Need one of {', '.join(_ISO_TOOLS)} to build a cloud-init seed image"
+        raise FileNotFoundError(msg)
+
+    with TemporaryDirectory(prefix="vm_spawner-seed-") as tmp:
+        seed_dir = Path(tmp)
+        shutil.copyfile(user_data, seed_dir / "user-data")
+        shutil.copyfile(network_config, seed_dir / "network-config")
+        (seed_dir / "meta-data").write_text(f"instance-id: {instance_id}\n")
+
+        cmd = [
+            tool,
+            "-output",
+            str(destination),
+            "-volid",
+            "cidata",
+            "-joliet",
+            "-rock",
+            "user-data",
+            "meta-data",
+            "network-config",
+        ]
+        log.debug(f"Building seed image: {' '.join(cmd)}")
+        try:
+            subprocess.run(
+                cmd, cwd=seed_dir, check=True, capture_output=True, text=True
+            )
+        except subprocess.CalledProcessError as e:
+            log.error(f"{Path(tool).name} failed:\n{e.stderr}")
+            msg = f"Failed to build cloud-init seed image {destination}"
+            raise RuntimeError(msg) from e
@@ -1,9 +1,20 @@
+import contextlib
+import io
+import os
 import shlex
 import subprocess
 import tarfile
 from pathlib import Path
 from shlex import quote
-from tempfile import TemporaryDirectory
+
+from .remote import ssh_base_command
+
+# Bytes handed to ssh per write when streaming a tarball to it
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# gzip level for upload(). The fastest one still shrinks text-heavy trees
+# severalfold, higher levels make zlib the bottleneck on a fast link
+UPLOAD_COMPRESSLEVEL = 1
 
 
 def upload(
@@ -48,72 +59,169 @@ def upload(
             )
             raise ValueError(msg)
 
-    # Create the tarball from the temporary directory
-    with TemporaryDirectory(prefix="facts-upload-") as tardir:
-        tar_path = Path(tardir) / "upload.tar.gz"
+    # The tarball is extracted next to the destination, which is only replaced
+    # once tar succeeded. A truncated upload leaves it untouched
+    cmd = None
+    if local_src.is_dir():
+        cmd = (
+            'mkdir -p "$(dirname "$0")" && tmp="$(mktemp -d "$0.XXXXXX")" || exit; '
+            'tar -C "$tmp" -xzf - && chmod "$1" "$tmp" && rm -rf "$0" && mv "$tmp" "$0"; '
+            'rc=$?; rm -rf "$tmp"; exit $rc'
+        )
+    elif local_src.is_file():
+        cmd = (
+            'tmp="$(mktemp -d "$0.XXXXXX")" || exit; '
+            'tar -C "$tmp" -xzf - && rm -f "$0" && mv "$tmp/$(basename "$0")" "$0"; '
+            'rc=$?; rm -rf "$tmp"; exit $rc'
+        )
+    else:
+        msg = f"Unsupported source type: {local_src}"
+        raise ValueError(msg)
+
+    cmd_2 = [
+        *ssh_base_command(host, ssh_key),
+        host,
+        "--",
+        f"bash -c {quote(cmd)}",
+        str(remote_dest),
+        f"{dir_mode:o}",
+    ]
+    print(shlex.join(cmd_2))
+    # The tarball is written straight into ssh's stdin as it is built, without
+    # staging it in a file first
+    with subprocess.Popen(cmd_2, stdin=subprocess.PIPE) as proc:
+        assert proc.stdin is not None
         # We set the permissions of the files and directories in the tarball to read only and owned by root
         # As first uploading the tarball and then changing the permissions can lead an attacker to
         # do a race condition attack
-        with tarfile.open(str(tar_path), "w:gz") as tar:
-            if local_src.is_dir():
-                # Handle directory upload
-                for root, dirs, files in local_src.walk():
-                    for mdir in dirs:
-                        dir_path = Path(root) / mdir
-                        tarinfo = tar.gettarinfo(
-                            dir_path, arcname=str(dir_path.relative_to(str(local_src)))
-                        )
-                        tarinfo.mode = dir_mode
-                        tarinfo.uname = file_user
-                        tarinfo.gname = file_group
-                        tar.addfile(tarinfo)
-                    for file in files:
-                        file_path = Path(root) / file
-                        tarinfo = tar.gettarinfo(
-                            file_path,
-                            arcname=str(file_path.relative_to(str(local_src))),
-                        )
-                        tarinfo.mode = file_mode
-                        tarinfo.uname = file_user
-                        tarinfo.gname = file_group
-                        with file_path.open("rb") as f:
-                            tar.addfile(tarinfo, f)
-            else:
-                # Handle single file upload
-                tarinfo = tar.gettarinfo(local_src, arcname=remote_dest.name)
+        tar = tarfile.open(  # noqa: SIM115 it must only be closed on success
+            fileobj=proc.stdin,
+            mode="w|gz",
+            bufsize=UPLOAD_CHUNK_SIZE,
+            compresslevel=UPLOAD_COMPRESSLEVEL,
+        )
+        try:
+            # A broken pipe means ssh failed, its returncode is reported below
+            with contextlib.suppress(BrokenPipeError):
+                _add_to_tar(
+                    tar,
+                    local_src,
+                    remote_dest,
+                    file_user,
+                    file_group,
+                    dir_mode,
+                    file_mode,
+                )
+                # Writes the gzip trailer, only a complete tarball gets one
+                tar.close()
+        except BaseException:
+            # The remote tar fails on the gzip stream that lacks its trailer,
+            # so the destination is left as it was
+            proc.kill()
+            raise
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                proc.stdin.close()
+            # Nothing reaches ssh anymore, this only releases an unfinished
+            # tarball instead of leaving its trailer to the garbage collector
+            with contextlib.suppress(ValueError):
+                tar.close()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd_2)
+
+
+def _add_to_tar(
+    tar: tarfile.TarFile,
+    local_src: Path,
+    remote_dest: Path,
+    file_user: str,
+    file_group: str,
+    dir_mode: int,
+    file_mode: int,
+) -> None:
+    """Adds local_src to tar the way upload() extracts it at remote_dest."""
+    if local_src.is_dir():
+        # Handle directory upload. Plain strings and one lstat per entry (inside
+        # gettarinfo), trees with thousands of files make this the hot loop
+        root_len = len(os.fspath(local_src)) + 1  # Including the separator
+        for root, dirs, files in os.walk(local_src):
+            for mdir in dirs:
+                dir_path = f"{root}/{mdir}"
+                tarinfo = tar.gettarinfo(dir_path, arcname=dir_path[root_len:])
+                tarinfo.mode = dir_mode
+                tarinfo.uname = file_user
+                tarinfo.gname = file_group
+                tar.addfile(tarinfo)
+            for file in files:
+                file_path = f"{root}/{file}"
+                tarinfo = tar.gettarinfo(file_path, arcname=file_path[root_len:])
                 tarinfo.mode = file_mode
                 tarinfo.uname = file_user
                 tarinfo.gname = file_group
-                with local_src.open("rb") as f:
+                if not tarinfo.isreg():  # e.g. a symlink, there is no content
+                    tar.addfile(tarinfo)
+                    continue
+                with open(file_path, "rb") as f:  # noqa: PTH123 file_path is a str already
                     tar.addfile(tarinfo, f)
+    else:
+        # Handle single file upload
+        tarinfo = tar.gettarinfo(local_src, arcname=remote_dest.name)
+        tarinfo.mode = file_mode
+        tarinfo.uname = file_user
+        tarinfo.gname = file_group
+        with local_src.open("rb") as f:
+            tar.addfile(tarinfo, f)
+
+
+def upload_files(
+    host: str,
+    files: dict[Path, str],  # local file -> file name inside remote_dir
+    remote_dir: Path,
+    file_user: str = "kvm",
+    file_group: str = "kvm",
+    file_mode: int = 0o400,
+    ssh_key: Path | None = None,
+    create_remote_dir: bool = False,
+) -> None:
+    """
+    Uploads several local files into remote_dir in one tarball over a single ssh
+    session, replacing files of the same name. Ownership and permissions are set
+    inside the tarball for the same reason as in upload().
 
-        cmd = None
-        if local_src.is_dir():
-            cmd = 'rm -rf "$0" && mkdir -m "$1" -p "$0" && tar -C "$0" -xzf -'
-        elif local_src.is_file():
-            cmd = 'rm -f "$0" && tar -C "$(dirname "$0")" -xzf -'
-        else:
-            msg = f"Unsupported source type: {local_src}"
+    remote_dir must exist unless create_remote_dir is set, then it is created
+    (mode 700) in the same session. An existing remote_dir is only accepted if
+    it is a real directory owned by the ssh user, never a symlink, as an
+    attacker could have planted it under a predictable name in /tmp.
+    """
+    for remote_name in files.values():
+        if "/" in remote_name or remote_name in ("", ".", ".."):
+            msg = f"Remote file name '{remote_name}' must be a plain file name"
             raise ValueError(msg)
 
-        # TODO accept `input` to be  an IO object instead of bytes so that we don't have to read the tarfile into memory.
-        with tar_path.open("rb") as f:
-            cmd_2 = [
-                "ssh",
-                "-o",
-                "StrictHostKeyChecking=no",
-                "-o",
-                "UserKnownHostsFile=/dev/null",
-            ]
-            if ssh_key:
-                cmd_2 += ["-i", str(ssh_key)]
-
-            cmd_2 += [
-                host,
-                "--",
-                f"bash -c {quote(cmd)}",
-                str(remote_dest),
-                f"{dir_mode:o}",
-            ]
-            print(shlex.join(cmd_2))
-            subprocess.run(cmd_2, input=f.read(), check=True)
+    # The files are small config files, build the tarball in memory
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for local_path, remote_name in files.items():
+            tarinfo = tar.gettarinfo(local_path, arcname=remote_name)
+            tarinfo.mode = file_mode
+            tarinfo.uname = file_user
+            tarinfo.gname = file_group
+            with local_path.open("rb") as f:
+                tar.addfile(tarinfo, f)
+
+    cmd = 'cd "$0" && rm -f -- "$@" && tar -xzf -'
+    if create_remote_dir:
+        cmd = (
+            '{ mkdir -m 700 "$0" 2>/dev/null || { [ -d "$0" ] && [ ! -L "$0" ] && [ -O "$0" ]; }; } && '
+            + cmd
+        )
+    ssh_cmd = [
+        *ssh_base_command(host, ssh_key),
+        host,
+        "--",
+        f"bash -c {quote(cmd)}",
+        quote(str(remote_dir)),
+        *map(quote, files.values()),
+    ]
+    print(shlex.join(ssh_cmd))
+    subprocess.run(ssh_cmd, input=buf.getvalue(), check=True)
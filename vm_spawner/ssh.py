@@ -37,23 +37,22 @@ def generate_ssh_key(root_dir: Path) -> SSHKeyPair:
 def ssh_into_machine(
     machines: list[TrMachine], target_name: str, keypair: SSHKeyPair
 ) -> None:
-    found = False
-    for machine in machines:
-        if machine["name"] == target_name:
-            found = True
-            target = f"root@{machine['ipv4']}"
-            log.info(f"ssh {target}")
-            subprocess.run(
-                [
-                    "ssh",
-                    "-o",
-                    "StrictHostKeyChecking=no",
-                    "-o",
-                    "UserKnownHostsFile=/dev/null",
-                    f"{target}",
-                    "-i",
-                    f"{keypair.private}",
-                ]
-            )
-    if not found:
+    # Names are unique (see generate_hetzner_config), connect to the first match
+    machine = next((m for m in machines if m["name"] == target_name), None)
+    if machine is None:
         log.error(f"Machine {target_name} not found")
+        return
+    target = f"root@{machine['ipv4']}"
+    log.info(f"ssh {target}")
+    subprocess.run(
+        [
+            "ssh",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "UserKnownHostsFile=/dev/null",
+            f"{target}",
+            "-i",
+            f"{keypair.private}",
+        ]
+    )
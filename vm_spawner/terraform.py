@@ -5,13 +5,13 @@ import json
 import logging
 import os
 import shutil
+import stat
 import subprocess
 import sys
-from getpass import getpass
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 
-from vm_spawner import hetzner
 from vm_spawner.assets import get_cloud_asset
 from vm_spawner.data import ArgMachine, Config, Provider, TrMachine
 from vm_spawner.errors import VmSpawnError
@@ -41,6 +41,8 @@ def ask(
             print(f"{text} (Finish with Ctrl-D): ")
             result = sys.stdin.read()
         case PromptType.HIDDEN:
+            from getpass import getpass
+
             result = getpass(f"{text} (hidden): ")
 
     log.info("Input received. Processing...")
@@ -48,8 +50,16 @@ def ask(
 
 
 def copy_from_nixstore(src: Path, dest: Path) -> None:
-    subprocess.run(["cp", "-r", str(src), str(dest)])
-    subprocess.run(["chmod", "-R", "u+w", str(dest)])
+    # Like cp -r, symlinks are copied as symlinks
+    shutil.copytree(src, dest, symlinks=True)
+    # Like chmod -R u+w, nix store contents are read-only
+    dest.chmod(dest.stat().st_mode | stat.S_IWUSR)
+    for root, dirs, files in dest.walk():
+        for name in (*dirs, *files):
+            path = root / name
+            mode = path.lstat().st_mode
+            if not stat.S_ISLNK(mode):  # chmod would change the link target
+                path.chmod(mode | stat.S_IWUSR)
 
 
 def tr_init(config: Config, provider: Provider) -> None:
@@ -75,10 +85,10 @@ def tr_init(config: Config, provider: Provider) -> None:
 def tr_metadata(config: Config) -> list[TrMachine]:
     res = subprocess.run(
         ["tofu", f"-chdir={config.tr_dir}", "output", "--json"],
-        text=True,
         capture_output=True,
         check=True,
     )
+    # json detects the UTF-8 itself, no need to decode the output first
     jdata = json.loads(res.stdout)
 
     machines = []
@@ -130,7 +140,13 @@ def generate_hetzner_config(
     location: str | None,
     ssh_pubkeys: list[str],
     machines: list[ArgMachine],
+    server_names: Future[list[str]] | None = None,
 ) -> None:
+    """
+    Writes the tofu variables for machines. Names already taken in the
+    project get a numeric suffix; server_names, if given, is a pending
+    get_hetzner_server_names call, made here otherwise.
+    """
     servers: list[dict[str, Any]] = []
 
     allowed_locations = {
@@ -156,21 +172,30 @@ def generate_hetzner_config(
         msg = f"Invalid location: {location}. Valid locations: {json.dumps(allowed_locations, indent=2)}"
         raise VmSpawnError(msg)
 
-    existing_machine_names = hetzner.get_hetzner_server_names(
-        os.environ["TF_VAR_hcloud_token"]
-    )
+    if server_names is None:
+        # Imported here, ssl and the API client are only needed for this provider
+        from vm_spawner import hetzner
+
+        existing_names = hetzner.get_hetzner_server_names(
+            os.environ["TF_VAR_hcloud_token"]
+        )
+    else:
+        existing_names = server_names.result()
+    # Names of existing servers and of the ones configured so far
+    taken_names = set(existing_names)
+    # Next suffix to try per name, so renaming n machines of one name is O(n)
+    next_index: dict[str, int] = {}
     for machine in machines:
         mname = machine["name"]
-        index = 0
-        if mname in existing_machine_names:
-            new_machine = f"{mname}-{index}"
+        if mname in taken_names:
             log.warning(f"Machine name '{mname}' already exists.")
-            while new_machine in existing_machine_names:
-                new_machine = f"{mname}-{index}"
+            index = next_index.get(mname, 0)
+            while f"{mname}-{index}" in taken_names:
                 index += 1
-
-            mname = new_machine
-            log.info(f"Renaming machine to '{new_machine}' to avoid conflict.")
+            next_index[mname] = index + 1
+            mname = f"{mname}-{index}"
+            log.info(f"Renaming machine to '{mname}' to avoid conflict.")
+        taken_names.add(mname)
 
         if machine["arch"] == "x86_64":
             server_type = "cpx11"
@@ -215,20 +240,30 @@ def tr_create(
     machines: list[ArgMachine],
 ) -> None:
     tr_ask_for_api_key(provider)
-    tr_init(config, provider)
-    ssh_pubkeys = [key.public.read_text() for key in config.ssh_keys]
-
-    match provider:
-        case Provider.Hetzner:
-            generate_hetzner_config(
-                config,
-                location,
-                ssh_pubkeys,
-                machines,
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        server_names = None
+        if provider == Provider.Hetzner:
+            from vm_spawner import hetzner
+
+            # Ask the API for the taken names while tofu init runs
+            server_names = executor.submit(
+                hetzner.get_hetzner_server_names, os.environ["TF_VAR_hcloud_token"]
             )
-        case _:
-            msg = f"Provider {provider} not implemented yet"
-            raise NotImplementedError(msg)
+        tr_init(config, provider)
+        ssh_pubkeys = [key.public.read_text() for key in config.ssh_keys]
+
+        match provider:
+            case Provider.Hetzner:
+                generate_hetzner_config(
+                    config,
+                    location,
+                    ssh_pubkeys,
+                    machines,
+                    server_names,
+                )
+            case _:
+                msg = f"Provider {provider} not implemented yet"
+                raise NotImplementedError(msg)
 
     subprocess.run(
         ["tofu", f"-chdir={config.tr_dir}", "apply", "-auto-approve"],